@@ -0,0 +1,65 @@
+from pathlib import Path
+import numpy as np
+import geopandas as gpd
+import rasterio
+import torch
+from rasterio import DatasetReader
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from shapely.geometry import box
+import config as cfg
+from db import get_model_column_for_mapped_name
+from building.models import Buildings
+from images.data.models import Classifier, Segmenter
+
+BLOCK_SIZE = 256
+
+
+def create_synthetic_img(file_path: Path, size: int, pixel_size: float, seed: int) -> None:
+    """
+    Write a tiled 3-band uint8 GeoTIFF in the source CRS. The image consists of smooth background noise with randomly
+    placed homogeneous rectangles (roughly resembling roofs) and is written in bands of blocks, so that also large
+    images can be created without holding them in memory.
+    """
+    rng = np.random.default_rng(seed)
+    profile = {'driver': 'GTiff', 'height': size, 'width': size, 'count': 3, 'dtype': 'uint8',
+               'crs': f'EPSG:{cfg.EPSG_SOURCE}', 'transform': from_origin(400000, 5750000, pixel_size, pixel_size),
+               'tiled': True, 'blockxsize': BLOCK_SIZE, 'blockysize': BLOCK_SIZE, 'compress': 'lzw'}
+    with rasterio.open(file_path, 'w', **profile) as dst:
+        for row_off in range(0, size, BLOCK_SIZE):
+            height = min(BLOCK_SIZE, size - row_off)
+            band = np.repeat(np.repeat(rng.integers(60, 120, (3, height // 16 + 1, size // 16 + 1)), 16, axis=1), 16,
+                             axis=2)[:, :height, :size]
+            band = band + rng.integers(-8, 8, band.shape)
+            for _ in range(size // 64):
+                row, col = rng.integers(0, height), rng.integers(0, size)
+                band[:, row:row + rng.integers(20, 80), col:col + rng.integers(20, 80)] = rng.integers(0, 255, (3, 1, 1))
+            dst.write(np.clip(band, 0, 255).astype(np.uint8), window=Window(0, row_off, size, height))
+
+def create_random_models(dir_path: Path, seed: int) -> None:
+    """
+    Save randomly initialized classifier and segmenter weights to the given directory (in place of
+    cfg.DIR_PATH_MODELS). The classifier is set to a constant score above the threshold, so that the segmenter
+    is run on all window clips (i.e. the worst case).
+    """
+    torch.manual_seed(seed)
+    classifier, segmenter = Classifier(imagenet_base=False), Segmenter(imagenet_base=False)
+    with torch.no_grad():
+        classifier.classifier[0].weight.zero_()
+        classifier.classifier[0].bias.fill_(1.0)
+    torch.save(classifier.state_dict(), dir_path / 'classifier.model')
+    torch.save(segmenter.state_dict(), dir_path / 'segmenter.model')
+
+def create_synthetic_buildings(img_tif_ds: DatasetReader, n_buildings: int, seed: int) -> gpd.GeoDataFrame:
+    """
+    Create random rectangular building footprints within the image extent in the format of
+    `Buildings.get_single_img_buildings`.
+    """
+    rng = np.random.default_rng(seed)
+    left, bottom, right, top = img_tif_ds.bounds
+    x_min, y_min = rng.uniform(left, right, n_buildings), rng.uniform(bottom, top, n_buildings)
+    x_size, y_size = rng.uniform(6, 30, n_buildings), rng.uniform(6, 30, n_buildings)
+    return gpd.GeoDataFrame({
+        get_model_column_for_mapped_name(Buildings, 'ogc_fid'): np.arange(n_buildings),
+        cfg.COL_GEOMETRY: [box(*bounds) for bounds in zip(x_min, y_min, x_min + x_size, y_min + y_size)]
+    }, geometry=cfg.COL_GEOMETRY, crs=img_tif_ds.crs).to_crs(f'EPSG:{cfg.EPSG_TARGET}')
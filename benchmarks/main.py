@@ -0,0 +1,305 @@
+import argparse
+import json
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime as dt
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Callable
+import numpy as np
+import torch
+from loguru import logger
+import config as cfg
+from db import get_model_column_for_mapped_name
+from logs.utils import start_logging
+
+IMG_NAME = 'benchmark'
+
+
+def get_peak_rss_mb() -> float:
+    """
+    ru_maxrss is reported in kilobytes on Linux and in bytes on macOS.
+    """
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / 1024 ** 2 if sys.platform == 'darwin' else peak_rss / 1024
+
+def get_latency_stats(seconds: list) -> dict:
+    latency_ms = np.array(seconds) * 1000
+    return {'mean': float(latency_ms.mean()), 'p50': float(np.percentile(latency_ms, 50)),
+            'p95': float(np.percentile(latency_ms, 95))} if len(latency_ms) > 0 else {}
+
+def setup_stage(work_dir: str, num_threads: int) -> None:
+    """
+    Every stage runs in a fresh process: point the config to the synthetic data and models of the benchmark.
+    """
+    cfg.DIR_PATH_IMG_DATA = work_dir
+    cfg.DIR_PATH_MODELS = work_dir
+    cfg.DIR_PATH_RESULTS = str(Path(work_dir) / 'results')
+    Path(cfg.DIR_PATH_RESULTS).mkdir(exist_ok=True)
+    torch.set_num_threads(num_threads)
+
+def benchmark_preprocessing(work_dir: str, params: dict) -> dict:
+    from images import get_img_tif_ds_reader_from_dir
+    from images.preprocessing.main import set_img_window_clips_gdf
+
+    setup_stage(work_dir, params['num_threads'])
+    seconds = []
+    with get_img_tif_ds_reader_from_dir(work_dir, IMG_NAME) as tif_ds_reader:
+        for _ in range(params['repeats']):
+            start = time.perf_counter()
+            window_clips = set_img_window_clips_gdf(tif_ds_reader, IMG_NAME)
+            seconds.append(time.perf_counter() - start)
+    return {'n_tiles': len(window_clips), 'seconds': float(np.median(seconds)),
+            'tiles_per_sec': len(window_clips) / float(np.median(seconds)), 'peak_rss_mb': get_peak_rss_mb()}
+
+def benchmark_prediction(work_dir: str, params: dict) -> dict:
+    """
+    The latency of each stage is measured per batch in a sequential run. The throughput is measured for the complete
+    (pipelined) prediction of the image.
+    """
+    from images import ImgWindowClips, get_img_tif_ds_reader_from_dir, get_window_from_dict
+    from images.utils import BatchNormalizer
+    from images.preprocessing.main import set_img_window_clips_gdf
+    from images.prediction.engine import get_inference_engines
+    from images.prediction.tiles import get_tile_source
+    from images.prediction import main as prediction
+
+    setup_stage(work_dir, params['num_threads'])
+    model = get_inference_engines(params['backend'], prediction.DEVICE)
+    idx_col = get_model_column_for_mapped_name(ImgWindowClips, 'index')
+    with get_img_tif_ds_reader_from_dir(work_dir, IMG_NAME) as tif_ds_reader:
+        window_clips = set_img_window_clips_gdf(tif_ds_reader, IMG_NAME).sort_values(by=[
+            get_model_column_for_mapped_name(ImgWindowClips, 'row_offset'),
+            get_model_column_for_mapped_name(ImgWindowClips, 'column_offset')])
+
+        stage_seconds = {stage: [] for stage in ['read', 'normalize', 'classify', 'segment', 'stitch']}
+        tile_source = get_tile_source(tif_ds_reader, params['stream_tiles'])
+        normalizer = BatchNormalizer(params['batch_size'])
+        total_pred = prediction.init_total_pred(tif_ds_reader, params['mask_storage'])
+        n_positive = 0
+        for window_dicts in prediction.get_batches(window_clips.to_dict('records'), params['batch_size']):
+            windows = [get_window_from_dict(window_dict) for window_dict in window_dicts]
+            start = time.perf_counter()
+            clips = prediction.read_window_clips(tile_source, windows)
+            stage_seconds['read'].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            img_tensor = prediction.get_tensor_from_np_img_batch(clips, normalizer)
+            stage_seconds['normalize'].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            pred_class = prediction.run_classification_for_batch(model['classifier'], img_tensor)
+            stage_seconds['classify'].append(time.perf_counter() - start)
+
+            positive_idx = np.flatnonzero(pred_class > cfg.PRED_CLASS_TH)
+            n_positive += len(positive_idx)
+            pred_masks = [None] * len(windows)
+            if len(positive_idx) > 0:
+                start = time.perf_counter()
+                positive_pred_masks = prediction.run_segmentation_for_batch(
+                    model['segmenter'], img_tensor[torch.from_numpy(positive_idx)])
+                stage_seconds['segment'].append(time.perf_counter() - start)
+                for i, pred_mask in zip(positive_idx, positive_pred_masks):
+                    pred_masks[i] = pred_mask
+
+            start = time.perf_counter()
+            for window_dict, window, window_pred_class, pred_mask in zip(window_dicts, windows, pred_class, pred_masks):
+                prediction.update_total_pred(total_pred, {'pred_class': window_pred_class, 'pred_mask': pred_mask},
+                                             window, tif_ds_reader, window_dict[idx_col])
+            stage_seconds['stitch'].append(time.perf_counter() - start)
+
+        seconds = []
+        for _ in range(params['repeats']):
+            start = time.perf_counter()
+            total_pred = prediction.predict_img_window_clips(
+                window_clips, tif_ds_reader, model, batch_size=params['batch_size'],
+                stream_tiles=params['stream_tiles'], num_workers=params['num_workers'],
+                queue_depth=params['queue_depth'], mask_storage=params['mask_storage'])
+            seconds.append(time.perf_counter() - start)
+        np.save(Path(work_dir) / 'pred_mask.npy', np.asarray(total_pred['pred_mask']))
+
+    return {'n_tiles': len(window_clips), 'n_positive_tiles': n_positive, 'seconds': float(np.median(seconds)),
+            'tiles_per_sec': len(window_clips) / float(np.median(seconds)),
+            'latency_ms': {stage: get_latency_stats(stage_seconds[stage]) for stage in stage_seconds},
+            'peak_rss_mb': get_peak_rss_mb()}
+
+def benchmark_postprocessing(work_dir: str, params: dict) -> dict:
+    from images import get_img_tif_ds_reader_from_dir
+    from images.postprocessing.main import extract_detections, _remove_detections_wo_buildings
+    from benchmarks.fixtures import create_synthetic_buildings
+
+    setup_stage(work_dir, params['num_threads'])
+    pred_mask = np.load(Path(work_dir) / 'pred_mask.npy')
+    stage_seconds = {stage: [] for stage in ['extract_detections', 'remove_detections_wo_buildings']}
+    with get_img_tif_ds_reader_from_dir(work_dir, IMG_NAME) as tif_ds_reader:
+        buildings_gdf = create_synthetic_buildings(tif_ds_reader, params['n_buildings'], params['seed'])
+        for _ in range(params['repeats']):
+            start = time.perf_counter()
+            detections_gdf = extract_detections(pred_mask, tif_ds_reader)
+            stage_seconds['extract_detections'].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            detections_with_buildings_gdf = _remove_detections_wo_buildings(detections_gdf, buildings_gdf)
+            stage_seconds['remove_detections_wo_buildings'].append(time.perf_counter() - start)
+
+    seconds = float(sum(np.median(stage_seconds[stage]) for stage in stage_seconds))
+    return {'n_detections': len(detections_gdf), 'n_detections_on_buildings': len(detections_with_buildings_gdf),
+            'seconds': seconds, 'latency_ms': {stage: get_latency_stats(stage_seconds[stage]) for stage in stage_seconds},
+            'peak_rss_mb': get_peak_rss_mb()}
+
+STAGES = {'preprocessing': benchmark_preprocessing, 'prediction': benchmark_prediction,
+          'postprocessing': benchmark_postprocessing}
+
+
+def run_stage(benchmark: Callable, work_dir: str, params: dict) -> dict:
+    """
+    Run the benchmark of a stage in a separate process, so that the peak RSS is measured per stage.
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+        return executor.submit(benchmark, work_dir, params).result()
+
+def get_git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(params: dict) -> dict:
+    from benchmarks.fixtures import create_synthetic_img, create_random_models
+
+    results = {'meta': {'timestamp': dt.now().isoformat(timespec='seconds'), 'git_commit': get_git_commit(),
+                        'python': platform.python_version(), 'torch': torch.__version__,
+                        'machine': platform.machine(), 'stride': cfg.STRIDE, 'params': params},
+               'stages': {}}
+    with tempfile.TemporaryDirectory() as work_dir:
+        create_synthetic_img(Path(work_dir) / f'{IMG_NAME}.tif', params['img_size'], params['pixel_size'],
+                             params['seed'])
+        create_random_models(Path(work_dir), params['seed'])
+        for stage, benchmark in STAGES.items():
+            logger.info(f'Running benchmark: {stage}')
+            results['stages'][stage] = run_stage(benchmark, work_dir, params)
+            logger.info(f'Benchmark {stage}: {results["stages"][stage]}')
+    return results
+
+def flatten_metrics(metrics: dict, prefix: str = '') -> dict:
+    flat = {}
+    for key, value in metrics.items():
+        if isinstance(value, dict):
+            flat.update(flatten_metrics(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+def compare_results(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Compare all timing and memory metrics to a baseline run. Throughput (tiles_per_sec) is better if higher, all other
+    metrics (seconds, latency, peak RSS) are better if lower. Return all metrics which are worse than the baseline by
+    more than the tolerance (relative).
+    """
+    current, previous = flatten_metrics(results['stages']), flatten_metrics(baseline['stages'])
+    regressions = []
+    for metric in sorted(current.keys() & previous.keys()):
+        if metric.split('.')[-1].startswith('n_') or previous[metric] == 0:
+            continue
+        change = (current[metric] - previous[metric]) / previous[metric]
+        worse = -change if metric.endswith('tiles_per_sec') else change
+        logger.info(f'{metric}: {previous[metric]:.3f} -> {current[metric]:.3f} ({change:+.1%})')
+        if worse > tolerance:
+            regressions.append(metric)
+    return regressions
+
+def main(output: str = None, compare: str = None, tolerance: float = cfg.BENCH_TOLERANCE, **params) -> list:
+    results = run_benchmarks(params)
+    output = output or Path(cfg.DIR_PATH_RESULTS) / cfg.DIR_NAME_RESULTS_BENCHMARKS / \
+        f'{dt.now().strftime("%y%m%d_%H%M%S")}.json'
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    logger.info(f'Benchmark results written to {output}')
+
+    regressions = []
+    if compare is not None:
+        with open(compare) as f:
+            regressions = compare_results(results, json.load(f), tolerance)
+        if regressions:
+            logger.warning(f'Regressions compared to {compare} (tolerance {tolerance:.0%}): {regressions}')
+    return regressions
+
+
+if __name__ == "__main__":
+    start_logging(__file__)
+    logger.add(sys.stderr, level='INFO')
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark the preprocessing, prediction and postprocessing of a synthetic image with randomly '
+                    'initialized models (offline and without database).')
+    parser.add_argument('--img_size',
+                        help='Specify the height and width (in pixels) of the synthetic image.',
+                        type=int,
+                        default=cfg.BENCH_IMG_SIZE)
+    parser.add_argument('--pixel_size',
+                        help='Specify the pixel size (in meters) of the synthetic image.',
+                        type=float,
+                        default=cfg.BENCH_PIXEL_SIZE)
+    parser.add_argument('--n_buildings',
+                        help='Specify the number of synthetic building footprints used for postprocessing.',
+                        type=int,
+                        default=cfg.BENCH_N_BUILDINGS)
+    parser.add_argument('--repeats',
+                        help='Specify how often each stage is repeated (the median is reported).',
+                        type=int,
+                        default=cfg.BENCH_REPEATS)
+    parser.add_argument('--seed',
+                        help='Specify the random seed for the synthetic image, buildings and model weights.',
+                        type=int,
+                        default=0)
+    parser.add_argument('--num_threads',
+                        help='Specify the number of threads used by pytorch.',
+                        type=int,
+                        default=torch.get_num_threads())
+    parser.add_argument('--batch_size',
+                        help='Specify the number of window clips that are stacked into a single batch for inference.',
+                        type=int,
+                        default=cfg.PRED_BATCH_SIZE)
+    parser.add_argument('--backend',
+                        help='Specify the inference backend.',
+                        choices=['eager', 'torchscript', 'onnxruntime'],
+                        default=cfg.PRED_BACKEND)
+    parser.add_argument('--stream_tiles',
+                        help='Specify whether window clips should be read from the image file on demand.',
+                        action=argparse.BooleanOptionalAction,
+                        default=cfg.PRED_STREAM_TILES)
+    parser.add_argument('--num_workers',
+                        help='Specify the number of threads which read and normalize upcoming batches.',
+                        type=int,
+                        default=cfg.PRED_NUM_WORKERS)
+    parser.add_argument('--queue_depth',
+                        help='Specify the maximum number of batches which are prepared ahead of the model.',
+                        type=int,
+                        default=cfg.PRED_QUEUE_DEPTH)
+    parser.add_argument('--mask_storage',
+                        help='Specify how the prediction mask is stored while predicting.',
+                        choices=['legacy', 'memory', 'memmap'],
+                        default=cfg.PRED_MASK_STORAGE)
+    parser.add_argument('--output',
+                        help='Specify the JSON file the results are written to. Defaults to '
+                             '<DIR_PATH_RESULTS>/benchmarks/<timestamp>.json.',
+                        default=None)
+    parser.add_argument('--compare',
+                        help='Specify the JSON file of a previous run to compare the results to. Exits with status 1 '
+                             'if any metric is worse than the tolerance.',
+                        default=None)
+    parser.add_argument('--tolerance',
+                        help='Specify the relative deterioration of a metric which is considered as a regression.',
+                        type=float,
+                        default=cfg.BENCH_TOLERANCE)
+    args = parser.parse_args()
+
+    regressions = main(**vars(args))
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,137 @@
+import argparse
+import functools
+import json
+import os
+import shutil
+from pathlib import Path
+import geopandas as gpd
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from loguru import logger
+import config as cfg
+from db import engine, get_model_column_for_mapped_name
+from logs.utils import start_logging
+from building.models import Buildings
+from images import ImgMetadata
+
+FILE_NAME_MANIFEST = 'manifest.json'
+
+
+@functools.lru_cache(maxsize=None)
+def is_cache_enabled() -> bool:
+    """
+    The cache requires pyarrow to read and write GeoParquet files. Without it, the buildings are queried from the DB.
+    """
+    if not cfg.BUILDING_CACHE:
+        return False
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        logger.warning('The building cache requires pyarrow, which is not installed: querying the buildings instead.')
+        return False
+    return True
+
+def get_cache_file_path(img_name: str) -> Path:
+    return Path(cfg.DIR_PATH_BUILDING_CACHE) / f'{img_name}.parquet'
+
+@functools.lru_cache(maxsize=None)
+def get_buildings_fingerprint() -> str:
+    """
+    The building table is identified by the number of buildings and aggregates of their ids, areas and image
+    assignments, which change whenever buildings are (re-)inserted or assigned to other images. The building table is
+    only queried once per process.
+    """
+    with Session(engine) as session:
+        fingerprint = session.query(
+            func.count(Buildings.ogc_fid),
+            func.sum(Buildings.ogc_fid),
+            func.sum(Buildings.geom_sqm),
+            func.sum(func.cardinality(Buildings.img_names))).one()
+    return ':'.join(str(value) for value in fingerprint)
+
+def load_manifest() -> dict:
+    file_path = Path(cfg.DIR_PATH_BUILDING_CACHE) / FILE_NAME_MANIFEST
+    if not file_path.exists():
+        return {}
+    with open(file_path) as f:
+        return json.load(f)
+
+def write_manifest(fingerprint: str) -> None:
+    """
+    The manifest is written under a temporary name first, so that parallel processes never read a partial manifest.
+    """
+    file_path = Path(cfg.DIR_PATH_BUILDING_CACHE) / FILE_NAME_MANIFEST
+    tmp_file_path = f'{file_path}.{os.getpid()}.tmp'
+    with open(tmp_file_path, 'w') as f:
+        json.dump({'fingerprint': fingerprint}, f)
+    os.replace(tmp_file_path, file_path)
+
+def clear_cache() -> None:
+    shutil.rmtree(cfg.DIR_PATH_BUILDING_CACHE, ignore_errors=True)
+    Path(cfg.DIR_PATH_BUILDING_CACHE).mkdir(parents=True, exist_ok=True)
+
+@functools.lru_cache(maxsize=None)
+def validate_cache() -> None:
+    """
+    Clear the cache if the building table has changed since the cache has been built. When images are processed by
+    parallel processes, the cache has to be validated in the parent process before spawning them, so that the
+    processes do not clear the files written by each other.
+    """
+    fingerprint = get_buildings_fingerprint()
+    if load_manifest().get('fingerprint') != fingerprint:
+        logger.info('Clearing the building cache: the building table has changed.')
+        clear_cache()
+        write_manifest(fingerprint)
+
+def write_cache_file(img_name: str, buildings_gdf: gpd.GeoDataFrame) -> None:
+    """
+    The file is written under a temporary name first, so that parallel processes never read partial files.
+    """
+    tmp_file_path = f'{get_cache_file_path(img_name)}.{os.getpid()}.tmp'
+    buildings_gdf.to_parquet(tmp_file_path, index=False)
+    os.replace(tmp_file_path, get_cache_file_path(img_name))
+
+def get_single_img_buildings(img_name: str) -> gpd.GeoDataFrame:
+    """
+    Read the building footprints of an image from the local cache (GeoParquet) instead of querying the DB. Images which
+    are missing in the cache are queried once and added to it.
+    """
+    if not is_cache_enabled():
+        return Buildings.get_single_img_buildings(img_name)
+    validate_cache()
+    if get_cache_file_path(img_name).exists():
+        return gpd.read_parquet(get_cache_file_path(img_name))
+    buildings_gdf = Buildings.get_single_img_buildings(img_name)
+    write_cache_file(img_name, buildings_gdf)
+    return buildings_gdf
+
+def build_cache(img_names: list) -> None:
+    """
+    Build the cache for all images from a single query of the building table: each building is assigned to all images
+    it intersects with. Images without buildings are cached as empty files.
+    """
+    if not is_cache_enabled():
+        return
+    validate_cache()
+    col_ogc_fid = get_model_column_for_mapped_name(Buildings, 'ogc_fid')
+    with Session(engine) as session:
+        query = session.query(
+            Buildings.ogc_fid, Buildings.geom, func.unnest(Buildings.img_names).label('img_name'))
+        buildings_gdf = gpd.read_postgis(query.statement, engine)
+    buildings_per_img = dict(tuple(buildings_gdf.groupby('img_name')))
+    for img_name in img_names:
+        img_buildings_gdf = buildings_per_img.get(img_name, buildings_gdf.iloc[:0])
+        write_cache_file(img_name, img_buildings_gdf[[col_ogc_fid, cfg.COL_GEOMETRY]]
+                         .drop_duplicates(col_ogc_fid).reset_index(drop=True))
+    logger.info(f'Cached the buildings of {len(img_names)} images.')
+
+def main() -> None:
+    build_cache(ImgMetadata.get_all()[get_model_column_for_mapped_name(ImgMetadata, 'img_name')].tolist())
+
+if __name__ == "__main__":
+    start_logging(__file__)
+
+    parser = argparse.ArgumentParser(description='Build the local cache of the building footprints per image.')
+    parser.parse_args()
+
+    main()
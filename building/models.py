@@ -1,4 +1,6 @@
 from sqlalchemy.ext.automap import automap_base
+from sqlalchemy.orm import Session
+import geopandas as gpd
 
 import config as cfg
 from sqlalchemy import Column, Integer, Float, String
@@ -24,3 +26,11 @@ class Buildings(Base):
     zip_codes = Column('zip_codes', ARRAY(String))
     img_names = Column('img_names', ARRAY(String))
     geom_sqm = Column(cfg.COL_GEOMETRY_AREA, Float)
+
+    @classmethod
+    def get_single_img_buildings(cls, img_name: str) -> gpd.GeoDataFrame:
+        with Session(engine) as session:
+            query = session.query(cls.ogc_fid, cls.geom)\
+                .distinct()\
+                .filter(cls.img_names.contains([img_name]))
+            return gpd.read_postgis(query.statement, engine)
@@ -1,2 +1,3 @@
 from .docker_utils import setup_docker
 from .utils import create_schema, engine, start_database, get_model_column_names, as_dict, get_model_column_for_mapped_name
+from .bulk import copy_to_postgis
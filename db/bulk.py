@@ -0,0 +1,91 @@
+import io
+from typing import Iterator, Union
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from sqlalchemy import inspect
+from db.base import engine
+import config as cfg
+
+IF_EXISTS = ['append', 'replace', 'upsert']
+NULL = r'\N'
+
+
+def copy_to_postgis(df: Union[pd.DataFrame, gpd.GeoDataFrame], name: str, schema: str, if_exists: str = 'append',
+                    chunksize: int = cfg.DB_COPY_CHUNKSIZE) -> None:
+    """
+    Bulk load a (Geo)DataFrame into a table by streaming it in chunks as CSV through COPY within a single transaction.
+    Geometries are encoded as hex EWKB (including their SRID), lists and sets as arrays. If the table does not exist,
+    it is created from the dtypes of the frame (as by `to_postgis`/`to_sql`), otherwise its definition is kept:
+    - append: insert all rows
+    - replace: truncate the table before inserting all rows
+    - upsert: insert all rows into a temporary table first, which are then inserted into the table or update the rows
+      with the same primary key
+    """
+    if if_exists not in IF_EXISTS:
+        raise ValueError(f'if_exists must be one of {IF_EXISTS}, got: {if_exists}')
+    create_table_if_not_exists(df, name, schema)
+    columns = ', '.join(f'"{column}"' for column in df.columns)
+    target = f'"tmp_{name}"' if if_exists == 'upsert' else f'{schema}."{name}"'
+    primary_key = inspect(engine).get_pk_constraint(name, schema=schema)['constrained_columns']
+    if if_exists == 'upsert' and not primary_key:
+        raise ValueError(f'Cannot upsert into {schema}.{name}: the table has no primary key.')
+    with engine.begin() as conn:
+        cursor = conn.connection.cursor()
+        if if_exists == 'replace':
+            cursor.execute(f'TRUNCATE TABLE {schema}."{name}"')
+        if if_exists == 'upsert':
+            cursor.execute(f'CREATE TEMP TABLE {target} (LIKE {schema}."{name}" INCLUDING DEFAULTS) ON COMMIT DROP')
+        for chunk in get_chunks(df, chunksize):
+            cursor.copy_expert(f"COPY {target} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '{NULL}')",
+                               get_csv_buffer(chunk))
+        if if_exists == 'upsert':
+            conflict_columns = ', '.join(f'"{column}"' for column in primary_key)
+            updates = ', '.join(f'"{column}" = EXCLUDED."{column}"' for column in df.columns
+                                if column not in primary_key)
+            cursor.execute(f'INSERT INTO {schema}."{name}" ({columns}) SELECT {columns} FROM {target} '
+                           f'ON CONFLICT ({conflict_columns}) DO {f"UPDATE SET {updates}" if updates else "NOTHING"}')
+
+def create_table_if_not_exists(df: Union[pd.DataFrame, gpd.GeoDataFrame], name: str, schema: str) -> None:
+    if inspect(engine).has_table(name, schema=schema):
+        return
+    if isinstance(df, gpd.GeoDataFrame):
+        df.iloc[:0].to_postgis(con=engine, name=name, schema=schema, index=False)
+    else:
+        df.iloc[:0].to_sql(con=engine, name=name, schema=schema, index=False)
+
+def get_chunks(df: pd.DataFrame, chunksize: int) -> Iterator[pd.DataFrame]:
+    for i in range(0, len(df), chunksize):
+        yield df.iloc[i:i + chunksize]
+
+def get_csv_buffer(df: pd.DataFrame) -> io.StringIO:
+    """
+    Missing values are written as NULL marker, so that empty strings are not read as NULL by COPY (as empty fields
+    would be). Consequently, strings equal to the NULL marker are read as NULL.
+    """
+    df = pd.DataFrame(df).copy(deep=False)
+    for column in df.columns:
+        if isinstance(df[column].dtype, gpd.array.GeometryDtype):
+            df[column] = get_hex_ewkb(gpd.GeoSeries(df[column]))
+        elif df[column].dtype == object and df[column].map(is_array).any():
+            df[column] = df[column].map(lambda x: get_array_literal(x) if is_array(x) else x)
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False, na_rep=NULL)
+    buffer.seek(0)
+    return buffer
+
+def get_hex_ewkb(geoseries: gpd.GeoSeries) -> np.ndarray:
+    srid = geoseries.crs.to_epsg() if geoseries.crs is not None else 0
+    return shapely.to_wkb(shapely.set_srid(np.asarray(geoseries.values), srid), hex=True, include_srid=True)
+
+def is_array(value) -> bool:
+    return isinstance(value, (list, set, tuple, np.ndarray))
+
+def get_array_literal(values: Union[list, set, tuple, np.ndarray]) -> str:
+    """
+    All elements are quoted (and quotes and backslashes escaped), which Postgres accepts for arrays of any type. Elements
+    which are None are written as NULL. Only one-dimensional arrays are supported.
+    """
+    return '{' + ','.join('NULL' if value is None else '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+                          for value in values) + '}'
@@ -3,10 +3,11 @@ from logs.utils import start_logging, logger
 from db.base import Base
 from db import engine, create_schema, start_database
 from building import Buildings
-from images import ImgMetadata, ImgRoofDetections, ImgWindowClips
+from images import ImgMetadata, ImgRoofDetections, ImgWindowClips, ImgWindowGrids, ImgWindowScores
 from mapping import MastrPerBuilding, RoofDetectionsPerMastr, RoofDetectionsPerBuilding
 from mastr import MastrSolar
 from ref_area import ZipBorders
+from ledger import StageLedger
 
 def main(drop_results: bool = True) -> None:
     """
@@ -15,11 +16,13 @@ def main(drop_results: bool = True) -> None:
     """
     start_database()
     if drop_results:
+        ImgWindowGrids.drop_view()
         Base.metadata.drop_all(engine)
     for schema in Base.metadata._schemas:
         create_schema(schema)
     Base.metadata.create_all(engine)
-    logger.info(f'Loaded models: {Buildings, ImgMetadata, ImgRoofDetections, ImgWindowClips, MastrPerBuilding, RoofDetectionsPerMastr, RoofDetectionsPerBuilding, MastrSolar, ZipBorders}')
+    ImgWindowGrids.create_view()
+    logger.info(f'Loaded models: {Buildings, ImgMetadata, ImgRoofDetections, ImgWindowClips, ImgWindowGrids, ImgWindowScores, MastrPerBuilding, RoofDetectionsPerMastr, RoofDetectionsPerBuilding, MastrSolar, ZipBorders, StageLedger}')
 
 
 if __name__ == "__main__":
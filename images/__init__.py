@@ -1,2 +1,2 @@
-from .models import ImgMetadata, ImgWindowClips, ImgRoofDetections
+from .models import ImgMetadata, ImgWindowClips, ImgWindowGrids, ImgWindowScores, ImgRoofDetections
 from .utils import get_window_from_dict, get_img_tif_ds_reader_from_dir
@@ -17,9 +17,9 @@ class ResnetBase(nn.Module):
             Whether or not to load weights pretrained on imagenet
     """
 
-    def __init__(self) -> None:
+    def __init__(self, imagenet_base: bool = True) -> None:
         super().__init__()
-        resnet = resnet34(weights=ResNet34_Weights.DEFAULT).float()
+        resnet = resnet34(weights=ResNet34_Weights.DEFAULT if imagenet_base else None).float()
         self.pretrained = nn.Sequential(*list(resnet.children())[:-2])
 
     def forward(self, x):
@@ -0,0 +1,60 @@
+"""
+Post-training static quantization (INT8) of the classifier and segmentation model for inference on the CPU.
+"""
+
+import copy
+from typing import Iterable
+import torch
+from torch import nn
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from .segmenter import Segmenter, UpBlock
+
+QUANTIZED_ENGINE = 'x86'
+
+
+class QuantizableUpBlock(nn.Module):
+    """Numerically equivalent version of the UpBlock which allows fusing its convolutions with the ReLU.
+
+    Since the ReLU is applied element-wise, it can be moved in front of the concatenation and thus applied to the
+    output of each convolution separately. The batchnorm follows the ReLU and hence cannot be fused with a convolution.
+    """
+
+    def __init__(self, up_block: UpBlock) -> None:
+        super().__init__()
+        self.conv_across = up_block.conv_across
+        self.conv_transpose = up_block.conv_transpose
+        self.relu_across = nn.ReLU()
+        self.relu_transpose = nn.ReLU()
+        self.batchnorm = up_block.batchnorm
+
+    def forward(self, x_up, x_across):
+        joint = torch.cat((self.relu_transpose(self.conv_transpose(x_up)),
+                           self.relu_across(self.conv_across(x_across))), dim=1)
+        return self.batchnorm(joint)
+
+
+def get_quantizable_model(model: nn.Module) -> nn.Module:
+    model = copy.deepcopy(model).eval()
+    if isinstance(model, Segmenter):
+        model.upsamples = nn.ModuleList([QuantizableUpBlock(up_block) for up_block in model.upsamples])
+    return model
+
+
+def quantize_model(model: nn.Module, calibration_batches: Iterable[torch.Tensor]) -> nn.Module:
+    """
+    Quantize a model to INT8 by post-training static quantization: convolutions, batchnorms and ReLUs are fused where
+    possible, the activation ranges are calibrated on the given batches (which should be representative of the input
+    data) and the model is converted to its quantized version.
+    """
+    torch.backends.quantized.engine = QUANTIZED_ENGINE
+    calibration_batches = iter(calibration_batches)
+    first_batch = next(calibration_batches)
+    prepared_model = prepare_fx(get_quantizable_model(model), get_default_qconfig_mapping(QUANTIZED_ENGINE),
+                                example_inputs=(first_batch,))
+    with torch.no_grad():
+        prepared_model(first_batch)
+        for batch in calibration_batches:
+            prepared_model(batch)
+    return convert_fx(prepared_model).eval()
@@ -5,7 +5,7 @@ Yasmin Elsharnoby: https://github.com/yasminhossam/fixMatchSeg-Muc
 
 import torch
 from torch import nn
-from typing import List
+from typing import List, Tuple
 from .base import ResnetBase
 
 
@@ -19,10 +19,9 @@ class Segmenter(ResnetBase):
     """
 
     def __init__(self, imagenet_base: bool = False) -> None:
-        super().__init__()
+        super().__init__(imagenet_base=imagenet_base)
 
         self.target_modules = [str(x) for x in [2, 4, 5, 6]]
-        self.hooks = self.add_hooks()
 
         self.relu = nn.ReLU()
         self.upsamples = nn.ModuleList([
@@ -35,38 +34,18 @@ class Segmenter(ResnetBase):
         self.conv_transpose = nn.ConvTranspose2d(16, 1, 1)
         self.sigmoid = nn.Sigmoid()
 
-    def add_hooks(self) -> List[torch.utils.hooks.RemovableHandle]:
-        hooks = []
-        for name, child in self.pretrained.named_children():
-            if name in self.target_modules:
-                hooks.append(child.register_forward_hook(self.save_output))
-        return hooks
-
-    def retrieve_hooked_outputs(self) -> List[torch.Tensor]:
-        # to be called in the forward pass, this method returns the tensors
-        # which were saved by the forward hooks
-        outputs = []
+    def encode(self, x: torch.Tensor) -> Tuple[torch.Tensor, List[torch.Tensor]]:
+        # runs the backbone and returns its output together with the outputs
+        # of the target modules (the skip connections), ordered from the
+        # largest to the smallest. The outputs are not stored on the modules,
+        # so that they are released after the forward pass and the model can
+        # be shared across threads
+        interim = []
         for name, child in self.pretrained.named_children():
+            x = child(x)
             if name in self.target_modules:
-                outputs.append(child.output)
-        return outputs
-
-    def cleanup(self) -> None:
-        # removes the hooks, and the tensors which were added
-        for name, child in self.pretrained.named_children():
-            if name in self.target_modules:
-                # allows the method to be safely called even if
-                # the hooks aren't there
-                try:
-                    del child.output
-                except AttributeError:
-                    continue
-        for hook in self.hooks: hook.remove()
-
-    @staticmethod
-    def save_output(module, input, output):
-        # the hook to add to the target modules
-        module.output = output
+                interim.append(x)
+        return x, interim
 
     def load_base(self, state_dict: dict) -> None:
         # This allows a model trained on the classifier to be loaded
@@ -76,10 +55,11 @@ class Segmenter(ResnetBase):
 
     def forward(self, x):
         org_input = x
-        x = self.relu(self.pretrained(x))
+        x, interim = self.encode(x)
+        x = self.relu(x)
         # we reverse the outputs so that the smallest output
         # is the first one we get, and the largest the last
-        interim = self.retrieve_hooked_outputs()[::-1]
+        interim = interim[::-1]
 
         for upsampler, interim_output in zip(self.upsamples[:-1], interim):
             x = upsampler(x, interim_output)
@@ -1,15 +1,17 @@
 import config as cfg
-from sqlalchemy import Column, Integer, String, ForeignKey
-from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy import Column, Integer, BigInteger, String, ForeignKey, Float, Boolean, text, select, exists
+from sqlalchemy.dialects.postgresql import ARRAY, DOUBLE_PRECISION
 from sqlalchemy.orm import relationship, Session
 from geoalchemy2 import Geometry
 from db import engine
 from db.base import Base
 import geopandas as gpd
+import pandas as pd
 
 class ImgMetadata(Base):
     """
     This class is helpful for plotting the spatial extent of each image, i.e. in QGis.
+    The size and modification time (in ns) of the file identify changed images when the catalog is updated.
     """
     __tablename__ = 'metadata'
     __table_args__ = {"schema": cfg.SCHEMA_IMAGES}
@@ -18,6 +20,8 @@ class ImgMetadata(Base):
     geom = Column(cfg.COL_GEOMETRY, Geometry(geometry_type='POLYGON', srid=4326))
     dir_path = Column('dir', String)
     file_path = Column('file', String)
+    file_size = Column('file_size', BigInteger)
+    file_mtime = Column('file_mtime', BigInteger)
 
     window_clips = relationship('ImgWindowClips', cascade="all,delete", backref="img")
 
@@ -51,10 +55,92 @@ class ImgWindowClips(Base):
 
     @classmethod
     def get_single_img_clips(cls, img_name: str) -> gpd.GeoDataFrame:
+        """
+        Virtual window clips (see: WINDOW_CLIPS_STORAGE) are read from the view deriving them from the window grid. The
+        storage is determined by the image's tiling (whether its grid is stored) instead of the current config, since
+        the storage can be passed to the preprocessing as well.
+        """
+        with Session(engine) as session:
+            is_virtual = session.execute(select(exists().where(ImgWindowGrids.img_name == img_name))).scalar()
+        if is_virtual:
+            return gpd.read_postgis(
+                text(f'SELECT * FROM {cfg.SCHEMA_IMAGES}.{ImgWindowGrids.view_name} WHERE img_name = :img_name'),
+                engine, geom_col=cfg.COL_GEOMETRY, params={'img_name': img_name})
         with Session(engine) as session:
             query = session.query(cls).filter(cls.img_name == img_name)
             return gpd.read_postgis(query.statement, engine)
 
+class ImgWindowGrids(Base):
+    """
+    This class models the parameters of the regular grid of window clips per image, which are stored instead of all
+    window clips if WINDOW_CLIPS_STORAGE is 'virtual'. The view (view_name) derives the window clips in the same format
+    as ImgWindowClips: windows are enumerated in row-major order and their bounds are computed from the affine
+    transform (coefficients a, b, c, d, e, f) of the image.
+    """
+    __tablename__ = 'window_grids'
+    __table_args__ = {"schema": cfg.SCHEMA_IMAGES}
+    view_name = 'window_clips_virtual'
+
+    img_name = Column('img_name', String, ForeignKey(ImgMetadata.img_name), primary_key=True)
+    height = Column('height', Integer)
+    width = Column('width', Integer)
+    stride = Column('stride', Integer)
+    size = Column('size', Integer)
+    transform = Column('transform', ARRAY(DOUBLE_PRECISION))
+    srid = Column('srid', Integer)
+
+    @classmethod
+    def drop_view(cls) -> None:
+        """
+        The view depends on the table, so it has to be dropped before the table can be dropped.
+        """
+        with engine.begin() as conn:
+            conn.execute(text(f'DROP VIEW IF EXISTS {cfg.SCHEMA_IMAGES}.{cls.view_name}'))
+
+    @classmethod
+    def create_view(cls) -> None:
+        with engine.begin() as conn:
+            conn.execute(text(f"""
+                CREATE OR REPLACE VIEW {cfg.SCHEMA_IMAGES}.{cls.view_name} AS
+                SELECT r.i * n.n_cols + c.j AS idx,
+                       ST_Transform(ST_MakeEnvelope(
+                           g.transform[1] * c.j * g.stride + g.transform[2] * (r.i * g.stride + g.size) + g.transform[3],
+                           g.transform[4] * c.j * g.stride + g.transform[5] * (r.i * g.stride + g.size) + g.transform[6],
+                           g.transform[1] * (c.j * g.stride + g.size) + g.transform[2] * r.i * g.stride + g.transform[3],
+                           g.transform[4] * (c.j * g.stride + g.size) + g.transform[5] * r.i * g.stride + g.transform[6],
+                           g.srid), {cfg.EPSG_TARGET}) AS {cfg.COL_GEOMETRY},
+                       c.j * g.stride AS col_off,
+                       r.i * g.stride AS row_off,
+                       g.size AS width,
+                       g.size AS height,
+                       g.img_name
+                FROM {cfg.SCHEMA_IMAGES}.{cls.__tablename__} g
+                CROSS JOIN LATERAL (SELECT (g.width + g.stride - 1) / g.stride AS n_cols,
+                                           (g.height + g.stride - 1) / g.stride AS n_rows) n
+                CROSS JOIN LATERAL generate_series(0, n.n_rows - 1) AS r(i)
+                CROSS JOIN LATERAL generate_series(0, n.n_cols - 1) AS c(j)
+            """))
+
+class ImgWindowScores(Base):
+    """
+    This class models the classifier scores of all predicted window clips (loaded in bulk from the score store).
+    """
+    __tablename__ = 'window_scores'
+    __table_args__ = {"schema": cfg.SCHEMA_IMAGES}
+
+    index = Column('idx', Integer, primary_key=True)
+    score = Column('score', Float)
+    gate = Column('gate', Boolean)
+    seconds = Column('seconds', Float)
+
+    img_name = Column('img_name', String, ForeignKey(ImgMetadata.img_name), primary_key=True)
+
+    @classmethod
+    def get_single_img_scores(cls, img_name: str) -> pd.DataFrame:
+        with Session(engine) as session:
+            query = session.query(cls).filter(cls.img_name == img_name)
+            return pd.read_sql(query.statement, engine)
+
 class ImgRoofDetections(Base):
     """
     This class models all detections found on buildings roofs
@@ -1,45 +1,138 @@
+import argparse
+from typing import Tuple
 import numpy as np
+import pandas as pd
 from rasterio import DatasetReader
 import rasterio.features as rf
+from scipy import ndimage
 from sqlalchemy.orm import Session
-from sqlalchemy import select
+from sqlalchemy import select, delete, exists
 from building.models import Buildings
+from building.cache import get_single_img_buildings, get_buildings_fingerprint
 from images.models import ImgMetadata, ImgRoofDetections
 from images.utils import prediction_exists, get_img, get_img_tif_ds_reader_from_dir, get_results_file_path
 from logs.utils import start_logging
-from db import engine, get_model_column_for_mapped_name
+from ledger.utils import get_fingerprint, get_file_fingerprint, is_stage_current, record_stage
+from db import engine, get_model_column_for_mapped_name, copy_to_postgis
 import config as cfg
 import geopandas as gpd
-from shapely.geometry import shape, MultiPolygon
+from shapely.geometry import shape
+
+STAGE = 'postprocessing'
 
 def detection_exists(img_name: str) -> bool:
     with Session(engine) as session:
-        stmt = select(ImgRoofDetections.index).where(ImgRoofDetections.img_name == img_name)
-        return len(session.execute(stmt).fetchall()) > 0
+        stmt = select(exists().where(ImgRoofDetections.img_name == img_name))
+        return session.execute(stmt).scalar()
 
 def load_pred_mask(img_tif_ds: DatasetReader) -> np.ndarray:
     return get_img(img_tif_ds)
 
 def extract_detections(pred_mask: np.ndarray, img_tif_ds: DatasetReader) -> gpd.GeoDataFrame:
     detections = (pred_mask == 1).astype(np.uint8)
-    panel_polygons = [
-        img_shape
-        for img_shape, img_value in rf.shapes(
-            detections, transform=img_tif_ds.profile['transform']
-        )
-        if img_value == 1
-    ]
-    detection_polygons = MultiPolygon([shape(s) for s in panel_polygons])
-    detection_polygons_gdf = gpd.GeoDataFrame(detection_polygons, columns=[cfg.COL_GEOMETRY], geometry=cfg.COL_GEOMETRY, crs=cfg.EPSG_SOURCE)
+    labels, is_relevant = _get_components_above_area(detections, img_tif_ds)
+    detection_polygons_gdf = _polygonize_components(detections, is_relevant[labels], img_tif_ds)
+    return detection_polygons_gdf.drop(columns='component')
+
+def _get_components_above_area(detections: np.ndarray, img_tif_ds: DatasetReader,
+                               min_area: float = cfg.DETECTION_SQM_TH * cfg.DETECTION_PREFILTER_MARGIN
+                               ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Label the connected components of the detections (4-connected, as polygonized by rf.shapes) and compute their areas
+    from their pixel counts and the pixel size of the image (in the source CRS). Returns the labels and whether each
+    label is not smaller than the minimum area (the background label 0 is not), so that the remaining components are
+    never polygonized.
+    """
+    labels, _ = ndimage.label(detections)
+    transform = img_tif_ds.profile['transform']
+    component_areas = np.bincount(labels.ravel()) * abs(transform.a * transform.e - transform.b * transform.d)
+    is_relevant = component_areas >= min_area
+    is_relevant[0] = False
+    return labels, is_relevant
+
+def _polygonize_components(components: np.ndarray, is_relevant: np.ndarray,
+                           img_tif_ds: DatasetReader) -> gpd.GeoDataFrame:
+    """
+    Polygonize the relevant pixels of the components and keep the value of each polygon as component.
+    """
+    component_shapes = list(rf.shapes(components, mask=is_relevant, transform=img_tif_ds.profile['transform']))
+    detection_polygons_gdf = gpd.GeoDataFrame(
+        {'component': np.array([value for _, value in component_shapes], dtype=np.int64),
+         cfg.COL_GEOMETRY: [shape(s) for s, _ in component_shapes]},
+        geometry=cfg.COL_GEOMETRY, crs=cfg.EPSG_SOURCE)
     detection_polygons_gdf.to_crs(crs=f"EPSG:{cfg.EPSG_TARGET}", inplace=True)
-    detection_polygons_gdf = _threshold_geom_area(detection_polygons_gdf)
-    return detection_polygons_gdf
+    return _threshold_geom_area(detection_polygons_gdf)
+
+def extract_detections_on_buildings(pred_mask: np.ndarray, img_tif_ds: DatasetReader,
+                                    buildings_in_image_gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """
+    Extract the detections and assign them to buildings in the raster domain: the building footprints are rasterized
+    onto the grid of the mask and each component is assigned the buildings found below its pixels. Components without
+    any building are dropped before polygonization. Components touching pixels covered by several footprints are
+    assigned by the spatial join instead.
+    """
+    building_labels = get_building_label_raster(buildings_in_image_gdf, img_tif_ds)
+    detections = (pred_mask == 1).astype(np.uint8).reshape(building_labels.shape)
+    labels, is_relevant = _get_components_above_area(detections, img_tif_ds)
+    component_ogc_fids, overlap_components = _get_component_ogc_fids(
+        labels, is_relevant, building_labels, buildings_in_image_gdf[get_model_column_for_mapped_name(Buildings, 'ogc_fid')])
+    is_relevant[:] = False
+    is_relevant[component_ogc_fids.index] = True
+    is_relevant[overlap_components] = True
+    detection_polygons_gdf = _polygonize_components(labels, is_relevant[labels], img_tif_ds)
+
+    is_overlap = detection_polygons_gdf['component'].isin(overlap_components)
+    detections_with_buildings_gdf = detection_polygons_gdf.loc[~is_overlap, [cfg.COL_GEOMETRY]].reset_index(drop=True)
+    detections_with_buildings_gdf[get_model_column_for_mapped_name(Buildings, 'ogc_fid')] = \
+        component_ogc_fids.loc[detection_polygons_gdf.loc[~is_overlap, 'component']].to_numpy()
+    return pd.concat([
+        detections_with_buildings_gdf,
+        _remove_detections_wo_buildings(detection_polygons_gdf.loc[is_overlap, [cfg.COL_GEOMETRY]], buildings_in_image_gdf)
+    ], ignore_index=True)
+
+def get_building_label_raster(buildings_in_image_gdf: gpd.GeoDataFrame, img_tif_ds: DatasetReader) -> np.ndarray:
+    """
+    Rasterize the building footprints onto the grid of the mask with the position of each building (starting at 1) as
+    label and 0 for pixels without buildings. All pixels touched by a footprint are labeled. Since a raster holds only a
+    single label per pixel, pixels touched by several footprints are labeled as BUILDING_LABEL_OVERLAP: they are found
+    by rasterizing the footprints a second time in reverse order, where these pixels keep a different label.
+    """
+    out_shape = (img_tif_ds.height, img_tif_ds.width)
+    building_labels = np.zeros(out_shape, dtype=np.int32)
+    if len(buildings_in_image_gdf) == 0:
+        return building_labels
+    footprints = [footprint.__geo_interface__ for footprint in buildings_in_image_gdf[cfg.COL_GEOMETRY].to_crs(epsg=cfg.EPSG_SOURCE)]
+    rasterize_params = {'out_shape': out_shape, 'transform': img_tif_ds.profile['transform'], 'all_touched': True}
+    rf.rasterize(zip(footprints, np.arange(1, len(footprints) + 1)), out=building_labels, **rasterize_params)
+    reverse_building_labels = rf.rasterize(zip(footprints[::-1], np.arange(len(footprints), 0, -1)), dtype=np.int32,
+                                           **rasterize_params)
+    building_labels[building_labels != reverse_building_labels] = cfg.BUILDING_LABEL_OVERLAP
+    return building_labels
+
+def _get_component_ogc_fids(labels: np.ndarray, is_relevant: np.ndarray, building_labels: np.ndarray,
+                            ogc_fids: pd.Series) -> Tuple[pd.Series, np.ndarray]:
+    """
+    Look up the building labels below the pixels of all relevant components. Returns the ogc_fid arrays of all
+    components on buildings (indexed by component) and the components touching overlapping footprints.
+    """
+    is_on_building = is_relevant[labels] & (building_labels != 0)
+    n_building_labels = len(ogc_fids) - cfg.BUILDING_LABEL_OVERLAP + 1
+    keys = pd.unique(labels[is_on_building].astype(np.int64) * n_building_labels
+                     + building_labels[is_on_building] - cfg.BUILDING_LABEL_OVERLAP)
+    keys.sort()
+    pairs = np.stack([keys // n_building_labels, keys % n_building_labels + cfg.BUILDING_LABEL_OVERLAP])
+    overlap_components = np.unique(pairs[0, pairs[1] == cfg.BUILDING_LABEL_OVERLAP])
+    pairs = pairs[:, ~np.isin(pairs[0], overlap_components)]
+    components, first_pos = np.unique(pairs[0], return_index=True)
+    component_ogc_fids = pd.Series(np.split(ogc_fids.to_numpy()[pairs[1] - 1], first_pos)[1:], index=components,
+                                   dtype=object)
+    return component_ogc_fids, overlap_components
 
 def _threshold_geom_area(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
     """
     Exclude detections smaller than expected size of single panel
     """
-    gdf[cfg.COL_GEOMETRY_AREA] = gdf[cfg.COL_GEOMETRY].to_crs('epsg:32633').map(lambda p: p.area)
+    gdf[cfg.COL_GEOMETRY_AREA] = gdf[cfg.COL_GEOMETRY].to_crs('epsg:32633').area
     gdf = gdf.loc[gdf[cfg.COL_GEOMETRY_AREA] >= cfg.DETECTION_SQM_TH]
     gdf.drop(columns=cfg.COL_GEOMETRY_AREA, inplace=True)
     return gdf
@@ -48,32 +141,23 @@ def add_building_reference(img_name: str, detections_gdf: gpd.GeoDataFrame = Non
     """
     Perform spatial join between detected panel and osm building polygons: only keep detections with join to buildings
     """
-    with Session(engine) as session:
-        buildings_in_image_query = session.query(Buildings.ogc_fid, Buildings.geom)\
-            .distinct()\
-            .filter(Buildings.img_names.contains([img_name]))
-        buildings_in_image_gdf = gpd.read_postgis(
-            sql=buildings_in_image_query.statement, con=buildings_in_image_query.session.bind)
-        return _remove_detections_wo_buildings(detections_gdf, buildings_in_image_gdf)
+    return _remove_detections_wo_buildings(detections_gdf, get_single_img_buildings(img_name))
 
 
 def _remove_detections_wo_buildings(detections_gdf, buildings_in_image_gdf):
     """"
-    Filter on detections being positioned on a building and add the corresponding building ids
-    """
-    detections_with_buildings_gdf = gpd.sjoin(
-        detections_gdf, buildings_in_image_gdf, how='inner', predicate='intersects')
-    detections_with_buildings_gdf.drop(columns='index_right', inplace=True)
-    detections_with_buildings_gdf.drop_duplicates(inplace=True)
-    detections_with_buildings_gdf[cfg.COL_GEOMETRY] = detections_with_buildings_gdf[cfg.COL_GEOMETRY].to_wkt()
-    detections_with_buildings_gdf = detections_with_buildings_gdf\
-        .groupby(detections_with_buildings_gdf[cfg.COL_GEOMETRY])\
-        [get_model_column_for_mapped_name(Buildings, 'ogc_fid')]\
-        .apply(list)\
-        .reset_index()
-    detections_with_buildings_gdf[get_model_column_for_mapped_name(Buildings, 'ogc_fid')] = detections_with_buildings_gdf[get_model_column_for_mapped_name(Buildings, 'ogc_fid')].apply(lambda x: set(x))
-    detections_with_buildings_gdf[cfg.COL_GEOMETRY] = gpd.GeoSeries.from_wkt(detections_with_buildings_gdf[cfg.COL_GEOMETRY], crs=f"EPSG:{cfg.EPSG_TARGET}")
-    return gpd.GeoDataFrame(detections_with_buildings_gdf, crs=f"EPSG:{cfg.EPSG_TARGET}", geometry=cfg.COL_GEOMETRY)
+    Filter on detections being positioned on a building and add the corresponding building ids. The detections are
+    queried against the spatial index of the buildings and the ids are aggregated by the position of the detections,
+    so that geometries are never serialized.
+    """
+    col_ogc_fid = get_model_column_for_mapped_name(Buildings, 'ogc_fid')
+    detection_pos, building_pos = buildings_in_image_gdf.sindex.query(
+        detections_gdf[cfg.COL_GEOMETRY], predicate='intersects')
+    pairs = np.unique(np.stack([detection_pos, buildings_in_image_gdf[col_ogc_fid].to_numpy()[building_pos]]), axis=1)
+    detection_pos, first_pos = np.unique(pairs[0], return_index=True)
+    detections_with_buildings_gdf = detections_gdf.iloc[detection_pos][[cfg.COL_GEOMETRY]].reset_index(drop=True)
+    detections_with_buildings_gdf[col_ogc_fid] = pd.Series(np.split(pairs[1], first_pos)[1:], dtype=object)
+    return detections_with_buildings_gdf
 
 def format_detections_gdf_to_model(img_name:str, gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
     gdf.index.names = [get_model_column_for_mapped_name(ImgRoofDetections, 'index')]
@@ -81,28 +165,65 @@ def format_detections_gdf_to_model(img_name:str, gdf: gpd.GeoDataFrame) -> gpd.G
     gdf[get_model_column_for_mapped_name(ImgRoofDetections, 'img_name')] = img_name
     return gdf
 
-def get_detections_gdf_from_pred_mask(img_name:str, img_tif_ds: DatasetReader) -> gpd.GeoDataFrame:
+def get_detections_gdf_from_pred_mask(img_name:str, img_tif_ds: DatasetReader,
+                                      building_assignment: str = cfg.BUILDING_ASSIGNMENT) -> gpd.GeoDataFrame:
+    if building_assignment == 'raster':
+        return format_detections_gdf_to_model(img_name, extract_detections_on_buildings(
+            load_pred_mask(img_tif_ds), img_tif_ds, get_single_img_buildings(img_name)))
     return format_detections_gdf_to_model(img_name, add_building_reference(img_name, extract_detections(load_pred_mask(img_tif_ds), img_tif_ds)))
 
 
-def run_postprocessing_for_image(img_name:str) -> None:
-    if prediction_exists(img_name) and not detection_exists(img_name):
+def delete_detections(img_name: str) -> None:
+    with Session(engine) as session:
+        session.execute(delete(ImgRoofDetections).where(ImgRoofDetections.img_name == img_name))
+        session.commit()
+
+def get_postprocessing_fingerprint(img_name: str, building_assignment: str) -> str:
+    """
+    The detections of an image depend on its mask file, the buildings and the parameters of the extraction.
+    """
+    return get_fingerprint(
+        get_file_fingerprint(get_results_file_path(cfg.DIR_NAME_RESULTS_PRED_MASK, f'{img_name}.tif')),
+        get_buildings_fingerprint(), cfg.DETECTION_SQM_TH, cfg.DETECTION_PREFILTER_MARGIN, building_assignment)
+
+def run_postprocessing_for_image(img_name:str, overwrite: bool = False,
+                                 building_assignment: str = cfg.BUILDING_ASSIGNMENT) -> None:
+    """
+    Detections are only extracted again if the mask, the buildings or the parameters have changed since the last run
+    (see: ledger) or if overwrite is True. Existing detections of the image are replaced.
+    """
+    if not prediction_exists(img_name):
+        return
+    fingerprint = get_postprocessing_fingerprint(img_name, building_assignment)
+    if not overwrite and is_stage_current(img_name, STAGE, fingerprint, lambda: detection_exists(img_name)):
+        return
+    with record_stage(img_name, STAGE, fingerprint) as stage:
         tif_ds_reader = get_img_tif_ds_reader_from_dir(get_results_file_path(cfg.DIR_NAME_RESULTS_PRED_MASK), img_name)
-        detection_gdf = get_detections_gdf_from_pred_mask(img_name, tif_ds_reader)
+        detection_gdf = get_detections_gdf_from_pred_mask(img_name, tif_ds_reader, building_assignment)
+        delete_detections(img_name)
 
-        detection_gdf.to_postgis(
-            con=engine,
+        copy_to_postgis(
+            detection_gdf,
             name=ImgRoofDetections.__tablename__,
             schema=ImgRoofDetections.__table_args__['schema'],
-            if_exists='append',
-            index=False,
-            chunksize=100)
+            if_exists='append')
+        stage['n_rows'] = len(detection_gdf)
 
-def main() -> None:
+def main(building_assignment: str = cfg.BUILDING_ASSIGNMENT) -> None:
     for img_metadata in ImgMetadata.get_all().iterrows():
         run_postprocessing_for_image(
-            img_name=img_metadata[1][get_model_column_for_mapped_name(ImgMetadata, 'img_name')],)
+            img_name=img_metadata[1][get_model_column_for_mapped_name(ImgMetadata, 'img_name')],
+            building_assignment=building_assignment)
 
 if __name__ == "__main__":
     start_logging(__file__)
-    main()
+
+    parser = argparse.ArgumentParser(description='Extract the detections on buildings from all predicted masks.')
+    parser.add_argument('--building_assignment',
+                        help='Specify whether detections are assigned to buildings by a spatial join of the detection '
+                             'polygons (vector) or by a lookup in the rasterized building footprints (raster).',
+                        choices=['vector', 'raster'],
+                        default=cfg.BUILDING_ASSIGNMENT)
+    args = parser.parse_args()
+
+    main(building_assignment=args.building_assignment)
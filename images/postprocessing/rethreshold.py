@@ -0,0 +1,59 @@
+import argparse
+from pathlib import Path
+from loguru import logger
+from logs.utils import start_logging
+from images.utils import get_img_tif_ds_reader_from_dir, get_results_file_path
+from images.prediction.main import init_compact_pred_mask, persist_compact_pred_mask_to_tiff
+from images.prediction.probability import check_proba_thresholds, get_pred_mask_from_proba
+from images.postprocessing.main import run_postprocessing_for_image
+import config as cfg
+
+
+def get_img_names_with_proba() -> list:
+    return sorted(file_path.stem for file_path in Path(get_results_file_path(cfg.DIR_NAME_RESULTS_PRED_PROBA)).glob('*.tif'))
+
+def rethreshold_pred_mask(img_name: str, class_th: float = cfg.PRED_CLASS_TH,
+                          segment_th: float = cfg.PRED_SEGMENT_TH) -> None:
+    """
+    Rebuild the mask of an image from its probability map block by block and overwrite the existing mask.
+    """
+    proba_tif_ds = get_img_tif_ds_reader_from_dir(get_results_file_path(cfg.DIR_NAME_RESULTS_PRED_PROBA), img_name)
+    check_proba_thresholds(proba_tif_ds, class_th)
+    scale = int(proba_tif_ds.tags().get('scale', cfg.PRED_PROBA_SCALE))
+    pred_mask = init_compact_pred_mask(proba_tif_ds.shape,
+                                       'memory' if cfg.PRED_MASK_STORAGE == 'legacy' else cfg.PRED_MASK_STORAGE)
+    for _, window in proba_tif_ds.block_windows(1):
+        pred_mask[window.toslices()] = get_pred_mask_from_proba(proba_tif_ds.read(window=window), class_th,
+                                                                segment_th, scale)
+    persist_compact_pred_mask_to_tiff(pred_mask, get_results_file_path(cfg.DIR_NAME_RESULTS_PRED_MASK, f'{img_name}.tif'),
+                                      proba_tif_ds, tags={'class_th': class_th, 'segment_th': segment_th})
+
+def main(class_th: float = cfg.PRED_CLASS_TH, segment_th: float = cfg.PRED_SEGMENT_TH,
+         detections: bool = True) -> None:
+    img_names = get_img_names_with_proba()
+    logger.info(f'Rethresholding {len(img_names)} images (classification: {class_th}, segmentation: {segment_th}).')
+    for img_name in img_names:
+        rethreshold_pred_mask(img_name, class_th, segment_th)
+        if detections:
+            run_postprocessing_for_image(img_name, overwrite=True)
+
+if __name__ == "__main__":
+    start_logging(__file__)
+
+    parser = argparse.ArgumentParser(description='Rebuild masks and detections from saved probability maps.')
+    parser.add_argument('--class_th',
+                        help='Specify the classification score above which windows are considered as positive. It '
+                             'cannot be lower than the threshold the probability maps have been predicted with.',
+                        type=float,
+                        default=cfg.PRED_CLASS_TH)
+    parser.add_argument('--segment_th',
+                        help='Specify the segmentation probability above which pixels are considered as positive.',
+                        type=float,
+                        default=cfg.PRED_SEGMENT_TH)
+    parser.add_argument('--detections',
+                        help='Specify whether the detections of all rethresholded images should be replaced as well.',
+                        action=argparse.BooleanOptionalAction,
+                        default=True)
+    args = parser.parse_args()
+
+    main(class_th=args.class_th, segment_th=args.segment_th, detections=args.detections)
@@ -0,0 +1,52 @@
+import numpy as np
+import geopandas as gpd
+import config as cfg
+from db import get_model_column_for_mapped_name
+from images.models import ImgWindowClips
+
+
+def get_window_offsets(window_clips: gpd.GeoDataFrame) -> tuple:
+    return (window_clips[get_model_column_for_mapped_name(ImgWindowClips, 'row_offset')].to_numpy(),
+            window_clips[get_model_column_for_mapped_name(ImgWindowClips, 'column_offset')].to_numpy())
+
+def get_coarse_windows(window_clips: gpd.GeoDataFrame) -> np.ndarray:
+    """
+    Flag all windows of the non-overlapping grid (i.e. with a stride of the window size), which is a subset of the
+    overlapping grid of window clips and still covers the entire image. The last remaining row and column of windows
+    are flagged as well, since the windows of the non-overlapping grid at the bottom and right boundary may have been
+    pruned as redundant (see: get_non_redundant_windows), leaving the boundary covered only by overlapping windows.
+    """
+    if cfg.IMSIZE_MODEL_IN % cfg.STRIDE != 0:
+        raise ValueError(f'Adaptive stride requires the window size ({cfg.IMSIZE_MODEL_IN}) to be a multiple of the '
+                         f'stride ({cfg.STRIDE}).')
+    row_off, col_off = get_window_offsets(window_clips)
+    return ((row_off % cfg.IMSIZE_MODEL_IN == 0) | (row_off == row_off.max(initial=0))) & \
+        ((col_off % cfg.IMSIZE_MODEL_IN == 0) | (col_off == col_off.max(initial=0)))
+
+def get_refinement_windows(window_clips: gpd.GeoDataFrame, is_coarse: np.ndarray, pred_class: dict,
+                           threshold: float = cfg.PRED_ADAPTIVE_REFINE_TH) -> np.ndarray:
+    """
+    Flag all remaining windows of the overlapping grid which overlap with at least one coarse window whose
+    classification score exceeds the threshold. Each window overlaps with at most 2x2 coarse windows, which are
+    looked up in a grid of the coarse classification results. Coarse windows of the last row or column which are not
+    aligned to the grid mark all grid cells they overlap with.
+    """
+    row_off, col_off = get_window_offsets(window_clips)
+    idx = window_clips[get_model_column_for_mapped_name(ImgWindowClips, 'index')].to_numpy()
+    coarse_row_off, coarse_col_off = row_off[is_coarse], col_off[is_coarse]
+    is_coarse_positive = np.array([pred_class.get(i, 0) > threshold for i in idx[is_coarse]], dtype=bool)
+    is_positive = np.zeros(((coarse_row_off.max(initial=0) + cfg.IMSIZE_MODEL_IN - 1) // cfg.IMSIZE_MODEL_IN + 2,
+                            (coarse_col_off.max(initial=0) + cfg.IMSIZE_MODEL_IN - 1) // cfg.IMSIZE_MODEL_IN + 2),
+                           dtype=bool)
+    for coarse_rows in [coarse_row_off // cfg.IMSIZE_MODEL_IN,
+                        (coarse_row_off + cfg.IMSIZE_MODEL_IN - 1) // cfg.IMSIZE_MODEL_IN]:
+        for coarse_cols in [coarse_col_off // cfg.IMSIZE_MODEL_IN,
+                            (coarse_col_off + cfg.IMSIZE_MODEL_IN - 1) // cfg.IMSIZE_MODEL_IN]:
+            np.logical_or.at(is_positive, (coarse_rows, coarse_cols), is_coarse_positive)
+
+    overlaps_positive = np.zeros(len(window_clips), dtype=bool)
+    for rows in [row_off // cfg.IMSIZE_MODEL_IN, (row_off + cfg.IMSIZE_MODEL_IN - 1) // cfg.IMSIZE_MODEL_IN]:
+        for cols in [col_off // cfg.IMSIZE_MODEL_IN, (col_off + cfg.IMSIZE_MODEL_IN - 1) // cfg.IMSIZE_MODEL_IN]:
+            overlaps_positive |= is_positive[np.minimum(rows, is_positive.shape[0] - 1),
+                                             np.minimum(cols, is_positive.shape[1] - 1)]
+    return overlaps_positive & ~is_coarse
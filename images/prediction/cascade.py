@@ -0,0 +1,104 @@
+import itertools
+import json
+import math
+import numpy as np
+import geopandas as gpd
+import torch
+from rasterio import DatasetReader
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+from loguru import logger
+import config as cfg
+from db import get_model_column_for_mapped_name
+from images.models import ImgWindowClips
+from images.utils import BatchNormalizer, get_results_file_path
+from images.prediction.tiles import InMemoryTileSource
+
+
+def get_screening_mask(img_tif_ds: DatasetReader, model: dict, decimation: int = cfg.CASCADE_DECIMATION,
+                       threshold: float = cfg.CASCADE_SCREEN_TH, batch_size: int = cfg.PRED_BATCH_SIZE) -> np.ndarray:
+    """
+    Classify overlapping windows of a downsampled copy of the image (read from its overviews if available) and return
+    a mask (at the downsampled resolution) of all regions covered by windows whose score exceeds the threshold. Since
+    the classifier has been trained on full resolution clips, a lower threshold than for the full resolution
+    classification should be used.
+    """
+    height, width = math.ceil(img_tif_ds.height / decimation), math.ceil(img_tif_ds.width / decimation)
+    tile_source = InMemoryTileSource(img_tif_ds.read(out_shape=(img_tif_ds.count, height, width),
+                                                     resampling=Resampling.average))
+    windows = [Window(col_off, row_off, cfg.IMSIZE_MODEL_IN, cfg.IMSIZE_MODEL_IN) for row_off, col_off in
+               itertools.product(range(0, height, cfg.STRIDE), range(0, width, cfg.STRIDE))]
+    normalizer = BatchNormalizer(batch_size)
+    screening_mask = np.zeros((height, width), dtype=bool)
+    for i in range(0, len(windows), batch_size):
+        batch = windows[i:i + batch_size]
+        with torch.no_grad():
+            scores = model['classifier'](torch.from_numpy(normalizer([tile_source.read(window) for window in batch])))
+        for window, score in zip(batch, scores.squeeze(1).cpu().numpy()):
+            if score > threshold:
+                screening_mask[window.toslices()] = True
+    return screening_mask
+
+def get_flagged_windows(window_clips: gpd.GeoDataFrame, screening_mask: np.ndarray,
+                        decimation: int = cfg.CASCADE_DECIMATION) -> np.ndarray:
+    """
+    Flag all full resolution windows overlapping with the screening mask, which is tested for all windows at once by
+    a summed-area table.
+    """
+    height, width = screening_mask.shape
+    row_min = window_clips[get_model_column_for_mapped_name(ImgWindowClips, 'row_offset')].to_numpy() // decimation
+    col_min = window_clips[get_model_column_for_mapped_name(ImgWindowClips, 'column_offset')].to_numpy() // decimation
+    row_max = np.minimum(row_min + math.ceil(cfg.IMSIZE_MODEL_IN / decimation), height)
+    col_max = np.minimum(col_min + math.ceil(cfg.IMSIZE_MODEL_IN / decimation), width)
+    summed_area = np.zeros((height + 1, width + 1), dtype=np.int64)
+    summed_area[1:, 1:] = screening_mask.cumsum(axis=0).cumsum(axis=1)
+    n_flagged = (summed_area[row_max, col_max] - summed_area[row_min, col_max]
+                 - summed_area[row_max, col_min] + summed_area[row_min, col_min])
+    return n_flagged > 0
+
+def get_audited_windows(is_flagged: np.ndarray, audit_rate: float = cfg.CASCADE_AUDIT_RATE,
+                        seed: int = 0) -> np.ndarray:
+    """
+    Sample windows which have not been flagged by the screening, which are predicted at full resolution anyway to
+    estimate the recall of the cascade.
+    """
+    rng = np.random.default_rng(seed)
+    return ~is_flagged & (rng.random(len(is_flagged)) < audit_rate)
+
+def get_cascade_windows(window_clips: gpd.GeoDataFrame, img_tif_ds: DatasetReader, model: dict) -> tuple:
+    is_flagged = get_flagged_windows(window_clips, get_screening_mask(img_tif_ds, model))
+    return is_flagged, get_audited_windows(is_flagged)
+
+def get_recall_estimate(n_positive_flagged: int, n_positive_audited: int, audit_rate: float) -> float:
+    """
+    The recall cannot be estimated without audited windows.
+    """
+    if audit_rate <= 0:
+        return None
+    n_positive = n_positive_flagged + n_positive_audited / audit_rate
+    return n_positive_flagged / n_positive if n_positive > 0 else 1.0
+
+def write_cascade_report(img_name: str, window_clips: gpd.GeoDataFrame, is_flagged: np.ndarray,
+                         is_audited: np.ndarray, pred_class: dict, audit_rate: float = cfg.CASCADE_AUDIT_RATE) -> dict:
+    """
+    The recall of the cascade is estimated on window level as the share of all windows classified as positive at full
+    resolution which have been flagged by the screening. The number of positive windows which have not been flagged
+    is extrapolated from the audited windows (exact for an audit rate of 1, undefined for an audit rate of 0).
+    """
+    idx = window_clips[get_model_column_for_mapped_name(ImgWindowClips, 'index')].to_numpy()
+    is_positive = np.array([pred_class.get(i, 0) > cfg.PRED_CLASS_TH for i in idx], dtype=bool)
+    n_positive_flagged = int(np.count_nonzero(is_positive & is_flagged))
+    n_positive_audited = int(np.count_nonzero(is_positive & is_audited))
+    cascade_stats = {
+        'n_windows': len(window_clips),
+        'n_flagged': int(np.count_nonzero(is_flagged)),
+        'n_audited': int(np.count_nonzero(is_audited)),
+        'n_positive_flagged': n_positive_flagged,
+        'n_positive_audited': n_positive_audited,
+        'recall': get_recall_estimate(n_positive_flagged, n_positive_audited, audit_rate),
+        'skip_ratio': float(1 - np.count_nonzero(is_flagged | is_audited) / len(window_clips))
+    }
+    logger.info(f'Cascade for {img_name}: {cascade_stats}')
+    with open(get_results_file_path(cfg.DIR_NAME_RESULTS_CASCADE, f'{img_name}.json'), 'w') as f:
+        json.dump(cascade_stats, f)
+    return cascade_stats
@@ -0,0 +1,106 @@
+import os
+import shutil
+import time
+from pathlib import Path
+import numpy as np
+from loguru import logger
+import config as cfg
+from images.utils import get_results_file_path
+
+
+def get_pred_array_keys(total_pred: dict) -> list:
+    return [key for key in ['pred_mask', 'pred_proba'] if key in total_pred]
+
+def copy_blockwise(src: np.ndarray, dst: np.ndarray, block_size: int = cfg.PRED_MASK_BLOCK_SIZE) -> None:
+    """
+    Copy the array in blocks of rows, so that memory-mapped arrays are never read into memory entirely.
+    """
+    for row in range(0, src.shape[-2], block_size):
+        dst[..., row:row + block_size, :] = src[..., row:row + block_size, :]
+
+
+class PredictionCheckpoint:
+    """
+    Periodically persists the partial prediction of an image (the mask and the classifier scores keyed by the window
+    idx) to the results directory, so that an interrupted prediction can be resumed from the last checkpoint.
+    Windows whose score is contained in the checkpoint are considered as completed. The masks are stored as (memory-
+    mapped) npy files which are written and read block by block, the scores in a small npz file. If a fingerprint of the prediction
+    (see: get_prediction_fingerprint) is passed, it is saved with the checkpoint and checkpoints of predictions with
+    other models, options or image files are ignored.
+    """
+
+    def __init__(self, img_name: str, interval: float = cfg.PRED_CHECKPOINT_INTERVAL, fingerprint: str = None) -> None:
+        self.img_name = img_name
+        self.fingerprint = fingerprint
+        self.interval = interval
+        self.dir_path = Path(get_results_file_path(cfg.DIR_NAME_RESULTS_CHECKPOINT)) / img_name
+        self.file_path = self.dir_path / 'checkpoint.npz'
+
+    def get_array_file_path(self, key: str) -> Path:
+        return self.dir_path / f'{key}.npy'
+        self.last_saved = time.monotonic()
+
+    def exists(self) -> bool:
+        return self.file_path.exists()
+
+    def load(self, total_pred: dict) -> set:
+        """
+        Restore the mask (and probability map) and classifier scores of the checkpoint into the (freshly initialized)
+        total prediction and return the idx of all completed windows. Checkpoints which do not match the mask (i.e.
+        created with a different mask storage or without probability map) are ignored.
+        """
+        if not self.exists():
+            return set()
+        with np.load(self.file_path) as checkpoint:
+            if self.fingerprint is not None and \
+                    ('fingerprint' not in checkpoint or str(checkpoint['fingerprint']) != self.fingerprint):
+                logger.warning(f'Ignoring checkpoint for {self.img_name}: it has been created by a prediction with '
+                               f'different models, options or image file.')
+                return set()
+            arrays = {key: np.load(self.get_array_file_path(key), mmap_mode='r')
+                      for key in get_pred_array_keys(total_pred) if self.get_array_file_path(key).exists()}
+            for key in get_pred_array_keys(total_pred):
+                if key not in arrays or arrays[key].shape != total_pred[key].shape or \
+                        arrays[key].dtype != total_pred[key].dtype:
+                    logger.warning(f'Ignoring checkpoint for {self.img_name}: it does not match the prediction mask.')
+                    return set()
+            for key in get_pred_array_keys(total_pred):
+                copy_blockwise(arrays[key], total_pred[key])
+            total_pred['pred_class'].update(zip(checkpoint['idx'].tolist(), checkpoint['score'].tolist()))
+            if 'seconds' in checkpoint:
+                total_pred['pred_seconds'].update(zip(checkpoint['idx'].tolist(), checkpoint['seconds'].tolist()))
+        logger.info(f'Resuming prediction for {self.img_name} from checkpoint: '
+                    f'{len(total_pred["pred_class"])} windows completed.')
+        return set(total_pred['pred_class'])
+
+    def update(self, total_pred: dict) -> None:
+        if time.monotonic() - self.last_saved >= self.interval:
+            self.save(total_pred)
+
+    def save(self, total_pred: dict) -> None:
+        """
+        All files are written under a temporary name first, so that an interruption while saving never corrupts the
+        previous checkpoint. The masks are replaced before the scores: masks which are ahead of the scores are
+        harmless, since the windows missing in the scores are merged into the masks again by the element-wise maximum.
+        """
+        self.dir_path.mkdir(parents=True, exist_ok=True)
+        for key in get_pred_array_keys(total_pred):
+            tmp_file_path = self.dir_path / f'{key}.tmp.npy'
+            array = np.lib.format.open_memmap(tmp_file_path, mode='w+', dtype=total_pred[key].dtype,
+                                              shape=total_pred[key].shape)
+            copy_blockwise(total_pred[key], array)
+            array.flush()
+            del array
+            os.replace(tmp_file_path, self.get_array_file_path(key))
+        tmp_file_path = self.dir_path / 'checkpoint.tmp.npz'
+        np.savez_compressed(tmp_file_path, idx=np.fromiter(total_pred['pred_class'].keys(), dtype=np.int64),
+                            score=np.fromiter(total_pred['pred_class'].values(), dtype=np.float32),
+                            seconds=np.array([total_pred['pred_seconds'].get(idx, np.nan)
+                                              for idx in total_pred['pred_class']], dtype=np.float32),
+                            **({} if self.fingerprint is None else {'fingerprint': np.array(self.fingerprint)}))
+        os.replace(tmp_file_path, self.file_path)
+        self.last_saved = time.monotonic()
+        logger.info(f'Saved checkpoint for {self.img_name}: {len(total_pred["pred_class"])} windows completed.')
+
+    def remove(self) -> None:
+        shutil.rmtree(self.dir_path, ignore_errors=True)
@@ -0,0 +1,168 @@
+import functools
+import os
+import tempfile
+from pathlib import Path
+import numpy as np
+import torch
+from torch import nn
+from loguru import logger
+import config as cfg
+from images.data.models import Classifier, Segmenter
+from images.data.models.quantization import QUANTIZED_ENGINE
+
+MODELS = {'classifier': Classifier, 'segmenter': Segmenter}
+# the segmenter is fully convolutional and can thus be run on inputs larger than the window clips
+DYNAMIC_AXES = {'classifier': {0: 'batch'}, 'segmenter': {0: 'batch', 2: 'height', 3: 'width'}}
+
+
+def get_model_file_path(model_name: str) -> Path:
+    return Path(cfg.DIR_PATH_MODELS) / f'{model_name}.model'
+
+def get_artifact_file_path(model_name: str, suffix: str) -> Path:
+    return Path(cfg.DIR_PATH_MODELS) / f'{model_name}.{suffix}'
+
+def artifact_is_current(artifact_path: Path, model_name: str) -> bool:
+    """
+    Compiled artifacts are considered outdated if the state dict of the model has been modified after their export.
+    """
+    return artifact_path.exists() and artifact_path.stat().st_mtime >= get_model_file_path(model_name).stat().st_mtime
+
+def build_model(model_name: str) -> nn.Module:
+    """
+    Construct the model without downloading pretrained weights (they are overwritten by the saved state dict anyway)
+    and set it to inference mode.
+    """
+    model = MODELS[model_name](imagenet_base=False)
+    model.load_state_dict(torch.load(f=get_model_file_path(model_name), map_location='cpu'))
+    model.eval()
+    return model
+
+def get_example_input() -> torch.Tensor:
+    return torch.zeros((1, 3, cfg.IMSIZE_MODEL_IN, cfg.IMSIZE_MODEL_IN))
+
+def save_artifact(artifact_path: Path, export) -> None:
+    """
+    Export to a temporary directory first, so that concurrent processes never load a partially written artifact.
+    All exported files (i.e. external weights of ONNX models) are moved next to the state dict of the model.
+    """
+    with tempfile.TemporaryDirectory(dir=artifact_path.parent) as tmp_dir:
+        export(Path(tmp_dir) / artifact_path.name)
+        for file_path in Path(tmp_dir).iterdir():
+            if file_path.name != artifact_path.name:
+                os.replace(file_path, artifact_path.parent / file_path.name)
+        os.replace(Path(tmp_dir) / artifact_path.name, artifact_path)
+
+
+class EagerEngine:
+    """
+    Runs the pytorch model as is.
+    """
+
+    def __init__(self, model_name: str, device: torch.device) -> None:
+        self.device = device
+        self.model = build_model(model_name).to(device)
+
+    def __call__(self, input: torch.Tensor) -> torch.Tensor:
+        return self.model(input.to(self.device))
+
+
+class TorchScriptEngine:
+    """
+    Runs a traced and frozen TorchScript version of the model which is cached next to the state dict of the model.
+    """
+    suffix = 'torchscript.pt'
+
+    def __init__(self, model_name: str, device: torch.device) -> None:
+        self.device = device
+        artifact_path = get_artifact_file_path(model_name, self.suffix)
+        if not artifact_is_current(artifact_path, model_name):
+            self.export(model_name, artifact_path)
+        self.model = torch.jit.load(artifact_path, map_location=device)
+
+    @staticmethod
+    def export(model_name: str, artifact_path: Path) -> None:
+        logger.info(f'Exporting {model_name} to TorchScript: {artifact_path}')
+        with torch.no_grad():
+            model = torch.jit.freeze(torch.jit.trace(build_model(model_name), get_example_input()))
+        save_artifact(artifact_path, lambda path: torch.jit.save(model, path))
+
+    def __call__(self, input: torch.Tensor) -> torch.Tensor:
+        return self.model(input.to(self.device))
+
+
+class OnnxRuntimeEngine:
+    """
+    Runs an ONNX version of the model on the CPU with ONNX Runtime. The exported model is cached next to the state dict
+    of the model.
+    """
+    suffix = 'onnx'
+
+    def __init__(self, model_name: str, device: torch.device = None) -> None:
+        import onnxruntime
+
+        artifact_path = get_artifact_file_path(model_name, self.suffix)
+        if not artifact_is_current(artifact_path, model_name):
+            self.export(model_name, artifact_path)
+        self.session = onnxruntime.InferenceSession(os.fspath(artifact_path), providers=['CPUExecutionProvider'])
+        if not self.has_dynamic_axes(model_name):
+            # exported before the spatial axes of the segmenter were dynamic
+            self.export(model_name, artifact_path)
+            self.session = onnxruntime.InferenceSession(os.fspath(artifact_path), providers=['CPUExecutionProvider'])
+
+    def has_dynamic_axes(self, model_name: str) -> bool:
+        input_shape = self.session.get_inputs()[0].shape
+        return all(not isinstance(input_shape[axis], int) for axis in DYNAMIC_AXES[model_name])
+
+    @staticmethod
+    def export(model_name: str, artifact_path: Path) -> None:
+        logger.info(f'Exporting {model_name} to ONNX: {artifact_path}')
+        with torch.no_grad():
+            save_artifact(artifact_path, lambda path: torch.onnx.export(
+                build_model(model_name), (get_example_input(),), os.fspath(path),
+                input_names=['input'], output_names=['output'],
+                dynamic_axes={'input': DYNAMIC_AXES[model_name], 'output': DYNAMIC_AXES[model_name]}))
+
+    def __call__(self, input: torch.Tensor) -> torch.Tensor:
+        output = self.session.run(None, {'input': input.cpu().numpy().astype(np.float32, copy=False)})[0]
+        return torch.from_numpy(output)
+
+
+class QuantizedEngine:
+    """
+    Runs a TorchScript version of the INT8 quantized model on the CPU which is cached next to the state dict of the
+    model. The quantized model needs to be calibrated beforehand by running `python images/prediction/quantization.py`.
+    """
+    suffix = 'int8.pt'
+
+    def __init__(self, model_name: str, device: torch.device = None) -> None:
+        artifact_path = get_artifact_file_path(model_name, self.suffix)
+        if not artifact_is_current(artifact_path, model_name):
+            raise FileNotFoundError(
+                f'No up-to-date quantized {model_name} found at {artifact_path}. '
+                f'Run `python images/prediction/quantization.py` to calibrate the quantized models.')
+        torch.backends.quantized.engine = QUANTIZED_ENGINE
+        self.model = torch.jit.load(artifact_path, map_location='cpu')
+
+    @classmethod
+    def export(cls, model_name: str, quantized_model: nn.Module) -> None:
+        artifact_path = get_artifact_file_path(model_name, cls.suffix)
+        logger.info(f'Exporting quantized {model_name} to TorchScript: {artifact_path}')
+        with torch.no_grad():
+            model = torch.jit.freeze(torch.jit.trace(quantized_model, get_example_input()))
+        save_artifact(artifact_path, lambda path: torch.jit.save(model, path))
+
+    def __call__(self, input: torch.Tensor) -> torch.Tensor:
+        return self.model(input.cpu())
+
+
+BACKENDS = {'eager': EagerEngine, 'torchscript': TorchScriptEngine, 'onnxruntime': OnnxRuntimeEngine,
+            'int8': QuantizedEngine}
+
+
+@functools.lru_cache(maxsize=None)
+def get_inference_engines(backend: str, device: torch.device) -> dict:
+    """
+    Load the classifier and segmentation model for the given backend. Engines are cached, so that models are only
+    loaded once per process.
+    """
+    return {model_name: BACKENDS[backend](model_name, device) for model_name in MODELS}
@@ -1,6 +1,13 @@
-from typing import Union
+import argparse
+import queue
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+from typing import Union, List, Iterator
 
 import rasterio
+import rasterio.shutil
 from rasterio._err import CPLE_AppDefinedError
 from rasterio.windows import Window
 from rasterio import DatasetReader
@@ -12,29 +19,44 @@ import torch
 from pathlib import Path
 import config as cfg
 from alive_progress import alive_bar
+from loguru import logger
 from images.utils import (
-    get_window_from_dict, normalize, get_img_tif_ds_reader_from_dir, get_img, prediction_exists, get_results_file_path)
+    get_window_from_dict, normalize, get_img_tif_ds_reader_from_dir, prediction_exists, get_results_file_path,
+    BatchNormalizer)
+from images.prediction.tiles import InMemoryTileSource, StreamingTileSource, get_tile_source
+from images.prediction.pipeline import PipelinedExecutor
+from images.prediction.engine import BACKENDS, get_inference_engines, get_model_file_path
+from images.prediction.pruning import get_relevant_windows
+from images.prediction.checkpoint import PredictionCheckpoint
+from images.prediction.adaptive import get_coarse_windows, get_refinement_windows
+from images.prediction.cascade import get_cascade_windows, write_cascade_report
+from images.prediction.regions import get_positive_regions, get_padded_region_shape, get_window_crop
+from images.prediction.probability import quantize_proba, binarize_proba, get_proba_tags
+from images.prediction.scores import (
+    get_classifier_fingerprint, get_score_store_fingerprint, get_empty_scores, load_scores, write_scores)
+from building.cache import is_cache_enabled, validate_cache
+from ledger.utils import get_fingerprint, get_file_fingerprint, is_stage_current, record_stage
 import numpy as np
+import pandas as pd
+import geopandas as gpd
 import os
 
 DEVICE = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+STAGE = 'prediction'
+_worker_model = None
 
-def load_fully_supervised_model() -> dict:
+def load_fully_supervised_model(backend: str = cfg.PRED_BACKEND) -> dict:
     """
-    Load the saved classifier and segmentation model and set to inference mode
+    Load the saved classifier and segmentation model for the given inference backend (in inference mode).
+    Models are only loaded once per process.
     """
-    model_dict = {}
-    for m in ['classifier', 'segmenter']:
-        model = eval(f'{m.capitalize()}()')
-        model.load_state_dict(torch.load(f=Path(cfg.DIR_PATH_MODELS) / f'{m}.model', map_location=DEVICE))
-        model.eval()
-        model.to(DEVICE)
-        model_dict[m] = model
-    return model_dict
+    return get_inference_engines(backend, DEVICE)
 
 def clip_img_to_window(img: np.ndarray, window: Window) -> np.ndarray:
-    img_clip = img[:, window.row_off:(window.row_off + window.height), window.col_off:(window.col_off + window.width)]
-    return fill_img_clip_boundary(img_clip)
+    return clip_tile_source_to_window(InMemoryTileSource(img), window)
+
+def clip_tile_source_to_window(tile_source: Union[InMemoryTileSource, StreamingTileSource], window: Window) -> np.ndarray:
+    return fill_img_clip_boundary(tile_source.read(window))
 
 def fill_img_clip_boundary(img_clip: np.ndarray) -> np.ndarray:
     """
@@ -47,23 +69,79 @@ def fill_img_clip_boundary(img_clip: np.ndarray) -> np.ndarray:
     return img_clip
 
 def run_prediction_for_clip(img: np.ndarray, window: Window, model: dict) -> dict:
-    img_tensor = get_tensor_from_np_img(clip_img_to_window(img=img, window=window))
-    window_pred_class = run_classification_for_clip(model=model['classifier'], input=img_tensor)
-    window_pred_mask = None
-    if window_pred_class > 0.5:
-        window_pred_mask = run_segmentation_for_clip(model=model['segmenter'], input=img_tensor)
-    return {'pred_class': window_pred_class, 'pred_mask': window_pred_mask}
+    return run_prediction_for_batch(tile_source=InMemoryTileSource(img), windows=[window], model=model)[0]
+
+def run_prediction_for_batch(tile_source: Union[InMemoryTileSource, StreamingTileSource], windows: List[Window],
+                             model: dict) -> List[dict]:
+    """
+    Stack the clips of all windows into a single batch for the classifier. Only the clips passing the classification
+    threshold are forwarded to the segmenter (as a separate batch).
+    """
+    img_tensor = get_tensor_from_np_img_batch(read_window_clips(tile_source=tile_source, windows=windows))
+    return run_prediction_for_tensor(img_tensor=img_tensor, model=model)
+
+def read_window_clips(tile_source: Union[InMemoryTileSource, StreamingTileSource], windows: List[Window]) -> List[np.ndarray]:
+    """
+    Clips at the image boundary are not padded here, since this is handled by the BatchNormalizer.
+    """
+    return [tile_source.read(window) for window in windows]
+
+def run_prediction_for_tensor(img_tensor: torch.Tensor, model: dict, segment: bool = True,
+                              probabilities: bool = False, stored_pred_class: np.ndarray = None) -> List[dict]:
+    """
+    If segment is False, only the classifier is run and the masks of all windows are left empty.
+    If probabilities is True, the quantized segmentation probabilities of all segmented windows are returned as well.
+    Stored classifier scores (NaN for windows without stored score) are reused instead of running the classifier. The
+    classification time is returned per window (NaN for reused scores).
+    """
+    batch_pred_class, batch_seconds = classify_missing_for_batch(model['classifier'], img_tensor, stored_pred_class)
+    batch_pred_mask, batch_pred_proba = [None] * len(batch_pred_class), [None] * len(batch_pred_class)
+    positive_idx = np.flatnonzero(batch_pred_class > cfg.PRED_CLASS_TH)
+    if segment and len(positive_idx) > 0:
+        positive_pred_proba = run_segmentation_proba_for_batch(
+            model=model['segmenter'], input=img_tensor[torch.from_numpy(positive_idx)])
+        for i, window_pred_proba in zip(positive_idx, positive_pred_proba):
+            batch_pred_mask[i] = binarize_proba(window_pred_proba)
+            if probabilities:
+                batch_pred_proba[i] = quantize_proba(window_pred_proba)
+    return [{'pred_class': window_pred_class, 'pred_mask': window_pred_mask, 'pred_proba': window_pred_proba,
+             'seconds': window_seconds}
+            for window_pred_class, window_pred_mask, window_pred_proba, window_seconds in
+            zip(batch_pred_class, batch_pred_mask, batch_pred_proba, batch_seconds)]
+
+def classify_missing_for_batch(model: Classifier, input: torch.Tensor, stored_pred_class: np.ndarray = None) -> tuple:
+    """
+    Run the classifier only on the clips without stored score. Its time is evenly attributed to these clips.
+    """
+    batch_pred_class = np.full(len(input), np.nan, dtype=np.float32) if stored_pred_class is None else \
+        stored_pred_class.astype(np.float32)
+    batch_seconds = np.full(len(input), np.nan)
+    missing_idx = np.flatnonzero(np.isnan(batch_pred_class))
+    if len(missing_idx) > 0:
+        start = time.perf_counter()
+        batch_pred_class[missing_idx] = run_classification_for_batch(
+            model=model, input=input if len(missing_idx) == len(input) else input[torch.from_numpy(missing_idx)])
+        batch_seconds[missing_idx] = (time.perf_counter() - start) / len(missing_idx)
+    return batch_pred_class, batch_seconds
 
 def run_classification_for_clip(model: Classifier, input: torch.Tensor) -> float:
+    return run_classification_for_batch(model=model, input=input)[0]
+
+def run_classification_for_batch(model: Classifier, input: torch.Tensor) -> np.ndarray:
     with torch.no_grad():
-        pred_class = model(input).squeeze(1).cpu().numpy()[0]
+        pred_class = model(input).squeeze(1).cpu().numpy()
     return pred_class
 
 def run_segmentation_for_clip(model: Segmenter, input: torch.Tensor) -> np.ndarray:
+    return run_segmentation_for_batch(model=model, input=input)[0]
+
+def run_segmentation_for_batch(model: Segmenter, input: torch.Tensor) -> np.ndarray:
+    return binarize_proba(run_segmentation_proba_for_batch(model=model, input=input))
+
+def run_segmentation_proba_for_batch(model: Segmenter, input: torch.Tensor) -> np.ndarray:
     with torch.no_grad():
-        pred_mask = model(input).squeeze(1).cpu().numpy()[0, :, :]
-    pred_mask = np.where(pred_mask <= 0.5, 0, 1).astype(np.uint8)
-    return pred_mask
+        pred_proba = model(input).squeeze(1).cpu().numpy()
+    return pred_proba
 
 def get_tensor_from_np_img(img: np.ndarray) -> torch.Tensor:
     """
@@ -73,25 +151,73 @@ def get_tensor_from_np_img(img: np.ndarray) -> torch.Tensor:
     img_transformed = normalize(image=img)
     return torch.as_tensor(img_transformed.copy(), device=DEVICE).float().unsqueeze(0)
 
-def init_total_pred(img_tif_ds: DatasetReader) -> dict:
+def get_tensor_from_np_img_batch(imgs: List[np.ndarray], normalizer: BatchNormalizer = None) -> torch.Tensor:
+    """
+    Apply transformation (here: normalization) to all clips of a batch and convert them to a single pytorch tensor of
+    shape (batch, channels, height, width). If a normalizer is passed, its buffer is reused and shared with the tensor
+    without copying (on the CPU).
+    """
+    normalizer = BatchNormalizer(len(imgs)) if normalizer is None else normalizer
+    return torch.from_numpy(normalizer(imgs)).to(DEVICE)
+
+def get_batches(window_dicts: List[dict], batch_size: int) -> Iterator[List[dict]]:
+    for i in range(0, len(window_dicts), batch_size):
+        yield window_dicts[i:i + batch_size]
+
+def init_total_pred(img_tif_ds: DatasetReader, mask_storage: str = cfg.PRED_MASK_STORAGE,
+                    save_probabilities: bool = cfg.PRED_SAVE_PROBABILITIES) -> dict:
     """
     Create a single-band template storing all predictions per mask. Initialize to the default specified in the config
     (PRED_MASK_DEFAULT_INIT) to allow visualizing which parts of the source image have been processed (i.e. in case
     prediction fails for a part of the image).
+    Compact masks ('memory' or 'memmap' storage) are stored as uint8 and initialized to PRED_MASK_NODATA instead.
+    If probabilities are saved, a compact two-band probability map (segmentation probability and classification score)
+    is added, which is stored in memory for the legacy mask storage.
     """
-    pred_mask = np.full((img_tif_ds.shape[0], img_tif_ds.shape[1]), cfg.PRED_MASK_DEFAULT_INIT)
-    ds_dtype = img_tif_ds.dtypes[0] if len(set(img_tif_ds.dtypes)) == 1 else cfg.PRED_MASK_DEFAULT_DTYPE
-    if ds_dtype == 'float32':
-        pred_mask = pred_mask.astype('float32')
-    return {'pred_class': [], 'pred_mask': pred_mask}
+    if mask_storage != 'legacy':
+        total_pred = {'pred_class': {}, 'pred_seconds': {},
+                      'pred_mask': init_compact_pred_mask(img_tif_ds.shape, mask_storage)}
+    else:
+        pred_mask = np.full((img_tif_ds.shape[0], img_tif_ds.shape[1]), cfg.PRED_MASK_DEFAULT_INIT)
+        ds_dtype = img_tif_ds.dtypes[0] if len(set(img_tif_ds.dtypes)) == 1 else cfg.PRED_MASK_DEFAULT_DTYPE
+        if ds_dtype == 'float32':
+            pred_mask = pred_mask.astype('float32')
+        total_pred = {'pred_class': {}, 'pred_seconds': {}, 'pred_mask': pred_mask}
+    if save_probabilities:
+        total_pred['pred_proba'] = init_compact_pred_mask(
+            (2, *img_tif_ds.shape), 'memory' if mask_storage == 'legacy' else mask_storage)
+    return total_pred
 
-def update_total_pred(total_pred: dict, window_pred: dict, window: Window, img_tif_ds: DatasetReader) -> dict:
-    total_pred['pred_class'] = update_total_pred_class(total_pred['pred_class'], window_pred['pred_class'])
+def init_compact_pred_mask(shape: tuple, mask_storage: str) -> np.ndarray:
+    """
+    Memory-mapped masks are backed by an anonymous temporary file in the results directory, which is removed as soon
+    as the mask is garbage collected.
+    """
+    if mask_storage == 'memmap':
+        pred_mask = np.memmap(tempfile.TemporaryFile(dir=get_results_file_path(cfg.DIR_NAME_RESULTS_PRED_MASK)),
+                              dtype=np.uint8, mode='w+', shape=shape)
+    else:
+        pred_mask = np.empty(shape, dtype=np.uint8)
+    pred_mask.fill(cfg.PRED_MASK_NODATA)
+    return pred_mask
+
+def is_compact_pred_mask(pred_mask: np.ndarray) -> bool:
+    return pred_mask.dtype == np.uint8
+
+def update_total_pred(total_pred: dict, window_pred: dict, window: Window, img_tif_ds: DatasetReader, idx: int) -> dict:
+    total_pred['pred_class'] = update_total_pred_class(total_pred['pred_class'], window_pred['pred_class'], idx)
+    if 'seconds' in window_pred:
+        total_pred['pred_seconds'][idx] = float(window_pred['seconds'])
     total_pred['pred_mask'] = update_total_pred_mask(total_pred['pred_mask'], window_pred['pred_mask'], window, img_tif_ds)
+    if 'pred_proba' in total_pred:
+        update_total_pred_proba(total_pred['pred_proba'], window_pred, window, img_tif_ds)
     return total_pred
 
-def update_total_pred_class(pred_class, window_pred_class) -> list:
-    pred_class.append(window_pred_class)
+def update_total_pred_class(pred_class: dict, window_pred_class: float, idx: int) -> dict:
+    """
+    Classifier scores are keyed by the idx of the window clip.
+    """
+    pred_class[idx] = float(window_pred_class)
     return pred_class
 
 def update_total_pred_mask(pred_mask: np.ndarray, window_pred: np.ndarray, window: Window, img_tif_ds: DatasetReader) -> np.ndarray:
@@ -101,27 +227,50 @@ def update_total_pred_mask(pred_mask: np.ndarray, window_pred: np.ndarray, windo
     predictions from getting overwritten.
     If the clip is from the bottom or right boundary, it won't have the full size and thus the window size needs to
     be handled accordingly.
+    For compact masks, all pixels of the window are marked as processed (i.e. PRED_MASK_NODATA is reset to 0, also for
+    windows classified as negative) before the maximum is taken in place.
     """
-    if window_pred is not None:
-        window_height = min(img_tif_ds.shape[0] - window.row_off, cfg.IMSIZE_MODEL_IN)
-        window_width = min(img_tif_ds.shape[1] - window.col_off, cfg.IMSIZE_MODEL_IN)
-        row_min, col_min = window.row_off, window.col_off
-        row_max, col_max = window.row_off + window_height, window.col_off + window_width
+    window_height = min(img_tif_ds.shape[0] - window.row_off, cfg.IMSIZE_MODEL_IN)
+    window_width = min(img_tif_ds.shape[1] - window.col_off, cfg.IMSIZE_MODEL_IN)
+    row_min, col_min = window.row_off, window.col_off
+    row_max, col_max = window.row_off + window_height, window.col_off + window_width
+    if is_compact_pred_mask(pred_mask):
+        pred_mask_window = pred_mask[row_min:row_max, col_min:col_max]
+        pred_mask_window[pred_mask_window == cfg.PRED_MASK_NODATA] = 0
+        if window_pred is not None:
+            np.maximum(pred_mask_window, window_pred[:window_height, :window_width], out=pred_mask_window)
+    elif window_pred is not None:
         pred_mask[row_min:row_max, col_min:col_max] = np.maximum(pred_mask[row_min:row_max, col_min:col_max],
                                                                  window_pred[:window_height, :window_width])
     return pred_mask
 
-def write_pred_to_dir(total_pred:dict, img_name: str, img_tif_ds: DatasetReader) -> None:
+def update_total_pred_proba(pred_proba: np.ndarray, window_pred: dict, window: Window,
+                            img_tif_ds: DatasetReader) -> np.ndarray:
+    """
+    Both bands of the probability map are merged like compact masks: the segmentation probability (first band) is
+    only available for segmented windows, the classification score (second band) is spread over the entire window.
+    """
+    update_total_pred_mask(pred_proba[0], window_pred['pred_proba'], window, img_tif_ds)
+    update_total_pred_mask(pred_proba[1], np.broadcast_to(quantize_proba(window_pred['pred_class']),
+                                                          (cfg.IMSIZE_MODEL_IN, cfg.IMSIZE_MODEL_IN)),
+                           window, img_tif_ds)
+    return pred_proba
+
+def write_pred_to_dir(total_pred:dict, img_name: str, img_tif_ds: DatasetReader, fingerprint: str = None,
+                      stored_scores: pd.DataFrame = None) -> None:
     Path(cfg.DIR_PATH_RESULTS).mkdir(exist_ok=True)
-    persist_to_np(total_pred['pred_class'], img_name)
+    write_scores(img_name, total_pred, fingerprint, stored_scores)
+    if 'pred_proba' in total_pred:
+        persist_compact_pred_mask_to_tiff(
+            total_pred['pred_proba'], get_results_file_path(cfg.DIR_NAME_RESULTS_PRED_PROBA, f'{img_name}.tif'),
+            img_tif_ds, tags=get_proba_tags())
     persist_to_tiff(total_pred['pred_mask'], img_name, img_tif_ds)
 
-def persist_to_np(pred_obj: Union[np.ndarray, list], img_name:str) -> None:
-    file_path = get_results_file_path(cfg.DIR_NAME_RESULTS_PRED_MASK if type(pred_obj) == np.ndarray else 'class', img_name)
-    np.save(file_path, pred_obj, allow_pickle=True)
-
 def persist_to_tiff(pred_mask: np.ndarray, img_name:str, img_tif_ds: DatasetReader) -> None:
     file_path = get_results_file_path(cfg.DIR_NAME_RESULTS_PRED_MASK, f"{img_name}.tif")
+    if is_compact_pred_mask(pred_mask):
+        persist_compact_pred_mask_to_tiff(pred_mask, file_path, img_tif_ds)
+        return
     try:
         with rasterio.open(file_path, 'w', **get_tif_ds_profile(img_tif_ds, pred_mask.dtype)) as dst:
             dst.write(np.array([pred_mask]))
@@ -129,35 +278,406 @@ def persist_to_tiff(pred_mask: np.ndarray, img_name:str, img_tif_ds: DatasetRead
         os.remove(file_path)
         persist_to_tiff(pred_mask, img_name, img_tif_ds)
 
+def persist_compact_pred_mask_to_tiff(pred_mask: np.ndarray, file_path: str, img_tif_ds: DatasetReader,
+                                      cog: bool = cfg.PRED_MASK_COG, tags: dict = None) -> None:
+    """
+    Write the mask block by block to a tiled GeoTIFF, so that memory-mapped masks are never loaded into memory at
+    once. The file is written under a temporary name first (and converted to a Cloud-Optimized GeoTIFF if specified),
+    so that an interrupted run does not leave a partial mask which would be considered as an existing prediction.
+    Masks with multiple bands (i.e. probability maps) are passed as arrays of shape (bands, height, width).
+    """
+    tmp_file_path = f'{file_path}.tmp'
+    pred_mask = pred_mask[np.newaxis] if pred_mask.ndim == 2 else pred_mask
+    with rasterio.open(tmp_file_path, 'w', **get_compact_tif_ds_profile(img_tif_ds, len(pred_mask))) as dst:
+        for _, window in dst.block_windows(1):
+            dst.write(pred_mask[(slice(None), *window.toslices())], window=window)
+        if tags is not None:
+            dst.update_tags(**tags)
+    if cog:
+        rasterio.shutil.copy(tmp_file_path, f'{tmp_file_path}.cog', driver='COG', compress='LZW',
+                             blocksize=cfg.PRED_MASK_BLOCK_SIZE)
+        os.replace(f'{tmp_file_path}.cog', file_path)
+        os.remove(tmp_file_path)
+    else:
+        os.replace(tmp_file_path, file_path)
+
 def get_tif_ds_profile(img_tif_ds: DatasetReader, dtype: str) -> property:
     profile = img_tif_ds.profile
     profile.update({'dtype': eval(f'rasterio.{dtype}'), 'count': 1, 'compress': 'lzw'})
     return profile
 
-def run_prediction_for_image(img_name: str, model: dict):
-    if prediction_exists(img_name=img_name):
+def get_compact_tif_ds_profile(img_tif_ds: DatasetReader, count: int = 1) -> dict:
+    profile = get_tif_ds_profile(img_tif_ds, 'uint8')
+    profile.pop('photometric', None)
+    profile.update({'driver': 'GTiff', 'count': count, 'nodata': cfg.PRED_MASK_NODATA, 'tiled': True,
+                    'blockxsize': cfg.PRED_MASK_BLOCK_SIZE, 'blockysize': cfg.PRED_MASK_BLOCK_SIZE})
+    return profile
+
+def get_sorted_img_window_clips(img_name: str) -> gpd.GeoDataFrame:
+    """
+    The tile source caches rows for consecutive windows which requires processing the windows in row-major order.
+    """
+    return ImgWindowClips.get_single_img_clips(img_name).sort_values(by=[
+        get_model_column_for_mapped_name(ImgWindowClips, 'row_offset'),
+        get_model_column_for_mapped_name(ImgWindowClips, 'column_offset')])
+
+def predict_img_window_clips(window_clips: gpd.GeoDataFrame, tif_ds_reader: DatasetReader, model: dict,
+                             batch_size: int = cfg.PRED_BATCH_SIZE, stream_tiles: bool = cfg.PRED_STREAM_TILES,
+                             num_workers: int = cfg.PRED_NUM_WORKERS, queue_depth: int = cfg.PRED_QUEUE_DEPTH,
+                             mask_storage: str = cfg.PRED_MASK_STORAGE, checkpoint: PredictionCheckpoint = None,
+                             show_progress: bool = True, total_pred: dict = None, segment: bool = True,
+                             save_probabilities: bool = cfg.PRED_SAVE_PROBABILITIES,
+                             stored_scores: pd.DataFrame = None) -> dict:
+    """
+    If a checkpoint is passed, the prediction is restored from it and only the remaining windows are processed.
+    The partial prediction is checkpointed periodically and whenever the prediction is interrupted by an error.
+    If a total prediction is passed, the predictions are merged into it (skipping all windows it already contains).
+    If stored scores are passed, the classifier is only run for windows without stored score. Windows which do not
+    need to be segmented (i.e. scored below the classification threshold) are not even read.
+    """
+    tile_source = get_tile_source(tif_ds_reader, stream_tiles)
+    if total_pred is None:
+        total_pred = init_total_pred(tif_ds_reader, mask_storage, save_probabilities)
+        if checkpoint is not None:
+            checkpoint.load(total_pred)
+    idx_col = get_model_column_for_mapped_name(ImgWindowClips, 'index')
+    window_clips = window_clips[~window_clips[idx_col].isin(total_pred['pred_class'].keys())]
+    stored_scores = stored_scores if stored_scores is not None else get_empty_scores()
+    stored_pred_class = window_clips[idx_col].map(stored_scores['score'])
+    is_reused = stored_pred_class.notna() & ((stored_pred_class <= cfg.PRED_CLASS_TH) | (not segment))
+    # the buffers of the normalizers are shared with the model input and can thus only be reused after the prediction:
+    # provide one for each batch which is prepared ahead of the model, read ahead and currently predicted
+    normalizers = queue.SimpleQueue()
+    for _ in range(queue_depth + 2 if num_workers > 0 else 1):
+        normalizers.put(BatchNormalizer(batch_size))
+
+    def transform(clips: List[np.ndarray]) -> tuple:
+        normalizer = normalizers.get()
+        return normalizer, get_tensor_from_np_img_batch(clips, normalizer)
+
+    def predict(window_dicts: List[dict], normalizer: BatchNormalizer, img_tensor: torch.Tensor) -> List[dict]:
+        batch_pred = run_prediction_for_tensor(img_tensor, model, segment, 'pred_proba' in total_pred, np.array(
+            [stored_scores['score'].get(window_dict[idx_col], np.nan) for window_dict in window_dicts]))
+        normalizers.put(normalizer)
+        return batch_pred
+
+    with alive_bar(len(window_clips), force_tty=True, bar='classic', disable=not show_progress) as bar:
+        def stitch(window_dicts: List[dict], batch_pred: List[dict]) -> None:
+            for window_dict, window_pred in zip(window_dicts, batch_pred):
+                if np.isnan(window_pred['seconds']):
+                    window_pred['seconds'] = stored_scores['seconds'].get(window_dict[idx_col], np.nan)
+                update_total_pred(total_pred, window_pred, get_window_from_dict(window_dict), tif_ds_reader,
+                                  window_dict[idx_col])
+            bar(len(window_dicts))
+            if checkpoint is not None:
+                checkpoint.update(total_pred)
+
+        try:
+            if is_reused.any():
+                stitch(window_clips[is_reused].to_dict('records'), [
+                    {'pred_class': score, 'pred_mask': None, 'pred_proba': None, 'seconds': np.nan}
+                    for score in stored_pred_class[is_reused]])
+            PipelinedExecutor(num_workers=num_workers, queue_depth=queue_depth).run(
+                batches=get_batches(window_clips[~is_reused].to_dict('records'), batch_size),
+                read=lambda window_dicts: read_window_clips(
+                    tile_source, [get_window_from_dict(window_dict) for window_dict in window_dicts]),
+                transform=lambda window_dicts, clips: transform(clips),
+                predict=lambda window_dicts, prepared: predict(window_dicts, *prepared),
+                stitch=stitch)
+        except BaseException:
+            if checkpoint is not None:
+                checkpoint.save(total_pred)
+            raise
+    return total_pred
+
+def predict_img_window_clips_adaptively(window_clips: gpd.GeoDataFrame, tif_ds_reader: DatasetReader, model: dict,
+                                        **kwargs) -> dict:
+    """
+    Predict the non-overlapping (coarse) windows first. The overlapping windows are only predicted where they overlap
+    with a coarse window classified as positive and are merged into the mask by the element-wise maximum.
+    """
+    is_coarse = get_coarse_windows(window_clips)
+    total_pred = predict_img_window_clips(window_clips[is_coarse], tif_ds_reader, model, **kwargs)
+    is_refined = get_refinement_windows(window_clips, is_coarse, total_pred['pred_class'])
+    logger.info(f'Adaptive stride: predicted {np.count_nonzero(is_coarse)} coarse windows, refining '
+                f'{np.count_nonzero(is_refined)} of {np.count_nonzero(~is_coarse)} overlapping windows.')
+    return predict_img_window_clips(window_clips[is_refined], tif_ds_reader, model, total_pred=total_pred, **kwargs)
+
+def segment_positive_regions(window_clips: gpd.GeoDataFrame, total_pred: dict, tif_ds_reader: DatasetReader,
+                             model: dict, batch_size: int = cfg.PRED_BATCH_SIZE,
+                             stream_tiles: bool = cfg.PRED_STREAM_TILES,
+                             max_size: int = cfg.PRED_REGION_MAX_SIZE) -> dict:
+    """
+    Segment regions of adjacent windows classified as positive in a single forward pass each, instead of segmenting
+    their overlapping window clips separately. Regions are padded to a multiple of 32 and batched by their padded
+    shape. Batches are bounded by the pixels of batch_size window clips (see: get_region_batch_size), so that they do
+    not need more memory than batches of windows. The predicted mask of each region is cropped back to its windows,
+    which are merged into the total prediction mask as before.
+    """
+    regions = get_positive_regions(window_clips, total_pred['pred_class'], max_size)
+    logger.info(f'Segmenting {sum(len(region["window_dicts"]) for region in regions)} positive windows as '
+                f'{len(regions)} regions.')
+    tile_source = get_tile_source(tif_ds_reader, stream_tiles)
+
+    def segment_batch(shape: tuple, batch: List[tuple]) -> None:
+        img_tensor = torch.from_numpy(BatchNormalizer(len(batch), shape)([clip for _, clip in batch])).to(DEVICE)
+        pred_probas = run_segmentation_proba_for_batch(model=model['segmenter'], input=img_tensor)
+        for (region, _), pred_proba in zip(batch, pred_probas):
+            pred_mask = binarize_proba(pred_proba)
+            for window_dict in region['window_dicts']:
+                update_total_pred_mask(total_pred['pred_mask'], pred_mask[get_window_crop(region, window_dict)],
+                                       get_window_from_dict(window_dict), tif_ds_reader)
+                if 'pred_proba' in total_pred:
+                    update_total_pred_mask(total_pred['pred_proba'][0],
+                                           quantize_proba(pred_proba[get_window_crop(region, window_dict)]),
+                                           get_window_from_dict(window_dict), tif_ds_reader)
+
+    # regions are read in row-major order (as required by the tile source) and segmented once a batch of the same
+    # shape is complete
+    batches = {}
+    for region in regions:
+        shape = get_padded_region_shape(region)
+        batches.setdefault(shape, []).append((region, tile_source.read(region['window'])))
+        if len(batches[shape]) == get_region_batch_size(shape, batch_size):
+            segment_batch(shape, batches.pop(shape))
+    for shape, batch in batches.items():
+        segment_batch(shape, batch)
+    return total_pred
+
+def get_region_batch_size(shape: tuple, batch_size: int) -> int:
+    """
+    The number of regions of the given (padded) shape with at most as many pixels as batch_size window clips. Regions
+    larger than that are segmented one at a time.
+    """
+    return max(1, batch_size * cfg.IMSIZE_MODEL_IN ** 2 // (shape[0] * shape[1]))
+
+def run_prediction_for_image(img_name: str, model: dict, batch_size: int = cfg.PRED_BATCH_SIZE,
+                             stream_tiles: bool = cfg.PRED_STREAM_TILES, num_workers: int = cfg.PRED_NUM_WORKERS,
+                             queue_depth: int = cfg.PRED_QUEUE_DEPTH, prune_windows: bool = cfg.PRED_PRUNE_WINDOWS,
+                             mask_storage: str = cfg.PRED_MASK_STORAGE, resume: bool = cfg.PRED_RESUME,
+                             show_progress: bool = True, adaptive_stride: bool = cfg.PRED_ADAPTIVE_STRIDE,
+                             cascade: bool = cfg.PRED_CASCADE, segment_regions: bool = cfg.PRED_SEGMENT_REGIONS,
+                             save_probabilities: bool = cfg.PRED_SAVE_PROBABILITIES,
+                             reuse_scores: bool = cfg.PRED_REUSE_SCORES):
+    """
+    If scores are reused, the classifier scores stored by previous runs for the same classifier are looked up instead
+    of running the classifier again.
+    Images are only predicted again if their image file, the models or the parameters have changed since their last
+    prediction (see: ledger) or if their mask has been removed.
+    """
+    fingerprint = get_score_store_fingerprint(img_name, model)
+    stage_fingerprint = get_prediction_fingerprint(img_name, get_classifier_fingerprint(model), prune_windows,
+                                                   adaptive_stride, cascade, segment_regions, save_probabilities)
+    if is_stage_current(img_name, STAGE, stage_fingerprint, lambda: prediction_exists(img_name=img_name)):
+        return
+    window_clips = get_sorted_img_window_clips(img_name)
+    if len(window_clips) == 0:
+        # not recorded in the ledger, so that the image is predicted once it has been tiled
+        logger.warning(f'Skipping the prediction of {img_name}: no window clips found, it has not been tiled yet.')
         return
+    checkpoint = PredictionCheckpoint(img_name, fingerprint=stage_fingerprint)
+    if not resume:
+        checkpoint.remove()
+    remove_pred_proba(img_name)
     tif_ds_reader = get_img_tif_ds_reader_from_dir(cfg.DIR_PATH_IMG_DATA, img_name)
-    img = get_img(tif_ds_reader)
-    total_pred = init_total_pred(tif_ds_reader)
-    window_clips = ImgWindowClips.get_single_img_clips(img_name)
-
-    if len(window_clips) > 0:
-        with alive_bar(len(window_clips), force_tty=True, bar='classic') as bar:
-            for window_dict in window_clips.to_dict('records'):
-                window = get_window_from_dict(window_dict)
-                window_pred = run_prediction_for_clip(img, window, model)
-                total_pred = update_total_pred(total_pred, window_pred, window, tif_ds_reader)
-                bar()
-
-        write_pred_to_dir(total_pred, img_name, tif_ds_reader)
-
-def main() -> None:
-    for img_metadata in ImgMetadata.get_all().iterrows():
-        run_prediction_for_image(
-            img_name=img_metadata[1][get_model_column_for_mapped_name(ImgMetadata, 'img_name')],
-            model=load_fully_supervised_model())
+    stored_scores = load_scores(img_name, fingerprint) if reuse_scores else None
+
+    with record_stage(img_name, STAGE, stage_fingerprint) as stage:
+        # the number of tiled windows (before pruning), which is never 0 for recorded predictions
+        stage['n_rows'] = len(window_clips)
+        if prune_windows:
+            window_clips = window_clips[get_relevant_windows(img_name, window_clips, tif_ds_reader)]
+        if cascade:
+            all_window_clips = window_clips
+            is_flagged, is_audited = get_cascade_windows(window_clips, tif_ds_reader, model)
+            window_clips = window_clips[is_flagged | is_audited]
+        predict = predict_img_window_clips_adaptively if adaptive_stride else predict_img_window_clips
+        total_pred = predict(window_clips, tif_ds_reader, model, batch_size=batch_size, stream_tiles=stream_tiles,
+                             num_workers=num_workers, queue_depth=queue_depth, mask_storage=mask_storage,
+                             checkpoint=checkpoint, show_progress=show_progress, segment=not segment_regions,
+                             save_probabilities=save_probabilities, stored_scores=stored_scores)
+        if segment_regions:
+            segment_positive_regions(window_clips, total_pred, tif_ds_reader, model, batch_size=batch_size,
+                                     stream_tiles=stream_tiles)
+        if cascade:
+            write_cascade_report(img_name, all_window_clips, is_flagged, is_audited, total_pred['pred_class'])
+        write_pred_to_dir(total_pred, img_name, tif_ds_reader, fingerprint, stored_scores)
+    checkpoint.remove()
+
+def get_prediction_fingerprint(img_name: str, classifier_fingerprint: str, prune_windows: bool,
+                               adaptive_stride: bool, cascade: bool, segment_regions: bool,
+                               save_probabilities: bool) -> str:
+    """
+    The mask of an image depends on the image file, the models, the window grid, the thresholds and the options
+    changing which windows are predicted (including their parameters).
+    """
+    return get_fingerprint(
+        get_file_fingerprint(os.path.join(cfg.DIR_PATH_IMG_DATA, f'{img_name}.tif')),
+        classifier_fingerprint, get_file_fingerprint(get_model_file_path('segmenter')),
+        cfg.STRIDE, cfg.IMSIZE_MODEL_IN, cfg.PRED_CLASS_TH, cfg.PRED_SEGMENT_TH,
+        prune_windows and [cfg.PRUNING_DECIMATION, cfg.PRUNING_HOMOGENEITY_STD],
+        adaptive_stride and [cfg.PRED_ADAPTIVE_REFINE_TH],
+        cascade and [cfg.CASCADE_DECIMATION, cfg.CASCADE_SCREEN_TH, cfg.CASCADE_AUDIT_RATE],
+        segment_regions and [cfg.PRED_REGION_MAX_SIZE], save_probabilities)
+
+def remove_pred_proba(img_name: str) -> None:
+    """
+    A probability map of a previous prediction must not outlive the mask it belongs to (see: rethreshold.py).
+    """
+    file_path = get_results_file_path(cfg.DIR_NAME_RESULTS_PRED_PROBA, f'{img_name}.tif')
+    if os.path.exists(file_path):
+        os.remove(file_path)
+
+def init_prediction_worker(backend: str, num_threads: int) -> None:
+    """
+    Initialize a worker process of the prediction pool: bound the number of pytorch threads and load the models once
+    per process.
+    """
+    global _worker_model
+    start_logging(__file__)
+    torch.set_num_threads(num_threads)
+    _worker_model = load_fully_supervised_model(backend)
+
+def run_prediction_for_image_in_worker(img_name: str, **kwargs) -> float:
+    start = time.perf_counter()
+    run_prediction_for_image(img_name=img_name, model=_worker_model, show_progress=False, **kwargs)
+    return time.perf_counter() - start
+
+def get_num_threads_per_process(num_processes: int, num_threads: int = None) -> int:
+    return num_threads if num_threads is not None else max(1, (os.cpu_count() or 1) // num_processes)
+
+def run_prediction_for_images_in_parallel(img_names: List[str], num_processes: int, num_threads: int, backend: str,
+                                          **kwargs) -> None:
+    """
+    Distribute the images across a pool of worker processes. The processes are spawned (instead of forked), so that
+    they do not inherit the thread pools of pytorch from the main process. The progress is logged per image, since
+    the progress bars of the workers are disabled.
+    """
+    logger.info(f'Predicting {len(img_names)} images with {num_processes} processes x {num_threads} threads.')
+    with ProcessPoolExecutor(max_workers=num_processes, mp_context=get_context('spawn'),
+                             initializer=init_prediction_worker, initargs=(backend, num_threads)) as executor:
+        futures = {executor.submit(run_prediction_for_image_in_worker, img_name, **kwargs): img_name
+                   for img_name in img_names}
+        for n_done, future in enumerate(as_completed(futures), start=1):
+            try:
+                seconds = future.result()
+            except BaseException:
+                logger.error(f'Prediction failed for image {futures[future]}.')
+                executor.shutdown(cancel_futures=True)
+                raise
+            logger.info(f'Predicted image {n_done}/{len(img_names)}: {futures[future]} ({seconds:.1f}s)')
+
+def main(batch_size: int = cfg.PRED_BATCH_SIZE, stream_tiles: bool = cfg.PRED_STREAM_TILES,
+         num_workers: int = cfg.PRED_NUM_WORKERS, queue_depth: int = cfg.PRED_QUEUE_DEPTH,
+         backend: str = cfg.PRED_BACKEND, prune_windows: bool = cfg.PRED_PRUNE_WINDOWS,
+         mask_storage: str = cfg.PRED_MASK_STORAGE, resume: bool = cfg.PRED_RESUME,
+         num_processes: int = cfg.PRED_NUM_PROCESSES, num_threads: int = cfg.PRED_NUM_THREADS,
+         adaptive_stride: bool = cfg.PRED_ADAPTIVE_STRIDE, cascade: bool = cfg.PRED_CASCADE,
+         segment_regions: bool = cfg.PRED_SEGMENT_REGIONS,
+         save_probabilities: bool = cfg.PRED_SAVE_PROBABILITIES,
+         reuse_scores: bool = cfg.PRED_REUSE_SCORES) -> None:
+    img_names = ImgMetadata.get_all()[get_model_column_for_mapped_name(ImgMetadata, 'img_name')].tolist()
+    kwargs = {'batch_size': batch_size, 'stream_tiles': stream_tiles, 'num_workers': num_workers,
+              'queue_depth': queue_depth, 'prune_windows': prune_windows, 'mask_storage': mask_storage,
+              'resume': resume, 'adaptive_stride': adaptive_stride, 'cascade': cascade,
+              'segment_regions': segment_regions, 'save_probabilities': save_probabilities,
+              'reuse_scores': reuse_scores}
+    if num_processes > 1:
+        if prune_windows and is_cache_enabled():
+            validate_cache()
+        run_prediction_for_images_in_parallel(img_names, num_processes, get_num_threads_per_process(
+            num_processes, num_threads), backend, **kwargs)
+        return
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    model = load_fully_supervised_model(backend)
+    for img_name in img_names:
+        run_prediction_for_image(img_name=img_name, model=model, **kwargs)
 
 if __name__ == "__main__":
     start_logging(__file__)
-    main()
+
+    parser = argparse.ArgumentParser(description='Predict segmentation masks for all images.')
+    parser.add_argument('--batch_size',
+                        help='Specify the number of window clips that are stacked into a single batch for inference.',
+                        type=int,
+                        default=cfg.PRED_BATCH_SIZE)
+    parser.add_argument('--stream_tiles',
+                        help='Specify whether window clips should be read from the image file on demand instead of '
+                             'loading the entire image into memory.',
+                        action=argparse.BooleanOptionalAction,
+                        default=cfg.PRED_STREAM_TILES)
+    parser.add_argument('--num_workers',
+                        help='Specify the number of threads which read and normalize upcoming batches while the model '
+                             'is running. If 0, all stages are run sequentially.',
+                        type=int,
+                        default=cfg.PRED_NUM_WORKERS)
+    parser.add_argument('--queue_depth',
+                        help='Specify the maximum number of batches which are prepared ahead of the model.',
+                        type=int,
+                        default=cfg.PRED_QUEUE_DEPTH)
+    parser.add_argument('--backend',
+                        help='Specify the inference backend. Compiled models are cached next to the saved models.',
+                        choices=list(BACKENDS),
+                        default=cfg.PRED_BACKEND)
+    parser.add_argument('--prune_windows',
+                        help='Specify whether windows without buildings, without image content (nodata or homogeneous) '
+                             'and redundant windows at the image boundary should be skipped.',
+                        action=argparse.BooleanOptionalAction,
+                        default=cfg.PRED_PRUNE_WINDOWS)
+    parser.add_argument('--mask_storage',
+                        help='Specify how the prediction mask is stored while predicting: as uint8 in memory or in a '
+                             'memory-mapped file (with PRED_MASK_NODATA for unprocessed pixels) or as int64 in memory '
+                             '(legacy).',
+                        choices=['legacy', 'memory', 'memmap'],
+                        default=cfg.PRED_MASK_STORAGE)
+    parser.add_argument('--resume',
+                        help='Specify whether interrupted predictions should be resumed from their last checkpoint '
+                             '(skipping all completed windows) instead of starting over.',
+                        action=argparse.BooleanOptionalAction,
+                        default=cfg.PRED_RESUME)
+    parser.add_argument('--num_processes',
+                        help='Specify the number of worker processes predicting separate images in parallel. Each '
+                             'process loads the models once. If 1, all images are predicted in the main process.',
+                        type=int,
+                        default=cfg.PRED_NUM_PROCESSES)
+    parser.add_argument('--num_threads',
+                        help='Specify the number of pytorch threads per process. Defaults to the number of cores '
+                             'divided by the number of processes.',
+                        type=int,
+                        default=cfg.PRED_NUM_THREADS)
+    parser.add_argument('--adaptive_stride',
+                        help='Specify whether the windows should be predicted on a non-overlapping grid first, '
+                             'refining the prediction with the overlapping windows only around positive windows.',
+                        action=argparse.BooleanOptionalAction,
+                        default=cfg.PRED_ADAPTIVE_STRIDE)
+    parser.add_argument('--cascade',
+                        help='Specify whether a downsampled copy of each image should be classified first, predicting '
+                             'only windows in regions flagged by it (and a sample of the remaining windows to estimate '
+                             'the recall).',
+                        action=argparse.BooleanOptionalAction,
+                        default=cfg.PRED_CASCADE)
+    parser.add_argument('--segment_regions',
+                        help='Specify whether adjacent windows classified as positive should be merged into regions '
+                             '(of at most PRED_REGION_MAX_SIZE pixels) which are segmented in a single forward pass.',
+                        action=argparse.BooleanOptionalAction,
+                        default=cfg.PRED_SEGMENT_REGIONS)
+    parser.add_argument('--save_probabilities',
+                        help='Specify whether the merged segmentation probabilities and classification scores should '
+                             'be saved as a quantized probability map next to the mask, from which masks and '
+                             'detections can be rebuilt for other thresholds by images/postprocessing/rethreshold.py.',
+                        action=argparse.BooleanOptionalAction,
+                        default=cfg.PRED_SAVE_PROBABILITIES)
+    parser.add_argument('--reuse_scores',
+                        help='Specify whether classifier scores stored by previous runs (of the same classifier) should '
+                             'be reused instead of running the classifier again.',
+                        action=argparse.BooleanOptionalAction,
+                        default=cfg.PRED_REUSE_SCORES)
+    args = parser.parse_args()
+
+    main(batch_size=args.batch_size, stream_tiles=args.stream_tiles, num_workers=args.num_workers,
+         queue_depth=args.queue_depth, backend=args.backend, prune_windows=args.prune_windows,
+         mask_storage=args.mask_storage, resume=args.resume, num_processes=args.num_processes,
+         num_threads=args.num_threads, adaptive_stride=args.adaptive_stride, cascade=args.cascade,
+         segment_regions=args.segment_regions, save_probabilities=args.save_probabilities,
+         reuse_scores=args.reuse_scores)
@@ -0,0 +1,122 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Any, Callable, Iterable, List
+import config as cfg
+
+_END_OF_STAGE = object()
+
+
+class PipelinedExecutor:
+    """
+    Runs the prediction for batches of window clips in overlapping stages:
+    1. A reader thread reads the clips of upcoming batches (in order, since tile sources are not thread-safe) and
+       hands them to a pool of worker threads which apply the transformation (i.e. normalization).
+       At most `queue_depth` batches are prepared ahead of the model.
+    2. The calling thread runs the model on the prepared batches in the order of the input batches.
+    3. A separate thread stitches the predictions into the image mask.
+    NumPy, rasterio and pytorch release the GIL for most of their work, so that the stages overlap in practice.
+    If `num_workers` is 0, all stages are run sequentially in the calling thread.
+    """
+
+    def __init__(self, num_workers: int = cfg.PRED_NUM_WORKERS, queue_depth: int = cfg.PRED_QUEUE_DEPTH) -> None:
+        self.num_workers = num_workers
+        self.queue_depth = max(1, queue_depth)
+
+    def run(self, batches: Iterable[List[Any]], read: Callable, transform: Callable, predict: Callable,
+            stitch: Callable) -> None:
+        """
+        :param batches: iterable of batches (i.e. lists of windows)
+        :param read: read(batch) returns the raw input data of a batch
+        :param transform: transform(batch, raw_input) returns the model input of a batch
+        :param predict: predict(batch, model_input) returns the predictions of a batch
+        :param stitch: stitch(batch, predictions) merges the predictions of a batch into the total prediction
+        """
+        if self.num_workers == 0:
+            for batch in batches:
+                stitch(batch, predict(batch, transform(batch, read(batch))))
+            return
+
+        prepared_batches = queue.Queue(maxsize=self.queue_depth)
+        predicted_batches = queue.Queue(maxsize=self.queue_depth)
+        stop = threading.Event()
+        errors = []
+
+        with ThreadPoolExecutor(max_workers=self.num_workers) as pool:
+            reader = threading.Thread(
+                target=self._read_batches, args=(batches, read, transform, pool, prepared_batches, stop, errors),
+                daemon=True)
+            stitcher = threading.Thread(
+                target=self._stitch_batches, args=(stitch, predicted_batches, stop, errors), daemon=True)
+            reader.start()
+            stitcher.start()
+            try:
+                while True:
+                    item = self._get(prepared_batches, stop)
+                    if item is _END_OF_STAGE:
+                        break
+                    batch, future = item
+                    self._put(predicted_batches, (batch, predict(batch, future.result())), stop)
+            except BaseException:
+                stop.set()
+                raise
+            finally:
+                self._put(predicted_batches, _END_OF_STAGE, stop)
+                stitcher.join()
+                stop.set()
+                reader.join()
+        if errors:
+            raise errors[0]
+
+    def _read_batches(self, batches: Iterable[List[Any]], read: Callable, transform: Callable,
+                      pool: ThreadPoolExecutor, prepared_batches: queue.Queue, stop: threading.Event,
+                      errors: list) -> None:
+        try:
+            for batch in batches:
+                if stop.is_set():
+                    return
+                future: Future = pool.submit(transform, batch, read(batch))
+                self._put(prepared_batches, (batch, future), stop)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            self._put(prepared_batches, _END_OF_STAGE, stop)
+
+    def _stitch_batches(self, stitch: Callable, predicted_batches: queue.Queue, stop: threading.Event,
+                        errors: list) -> None:
+        while True:
+            item = self._get(predicted_batches, stop)
+            if item is _END_OF_STAGE:
+                return
+            try:
+                stitch(*item)
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+                return
+
+    @staticmethod
+    def _put(q: queue.Queue, item: Any, stop: threading.Event) -> None:
+        """
+        Put an item into a bounded queue without blocking forever if the pipeline has been stopped due to an error.
+        """
+        while True:
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                if stop.is_set():
+                    return
+
+    @staticmethod
+    def _get(q: queue.Queue, stop: threading.Event) -> Any:
+        """
+        Get an item from a queue and signal the end of the stage if the pipeline has been stopped due to an error.
+        """
+        while True:
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                if stop.is_set():
+                    return _END_OF_STAGE
@@ -0,0 +1,42 @@
+import numpy as np
+from rasterio import DatasetReader
+import config as cfg
+
+
+def quantize_proba(pred_proba: np.ndarray) -> np.ndarray:
+    """
+    Quantize probabilities in [0, 1] to uint8 (0 to PRED_PROBA_SCALE), which keeps PRED_MASK_NODATA free for pixels
+    which have not been processed. Probabilities are rounded up, so that thresholding the quantized probabilities at
+    any multiple of 1 / PRED_PROBA_SCALE (e.g. 0.5) is exact.
+    """
+    return np.ceil(np.clip(pred_proba, 0, 1) * cfg.PRED_PROBA_SCALE).astype(np.uint8)
+
+def binarize_proba(pred_proba: np.ndarray, threshold: float = cfg.PRED_SEGMENT_TH) -> np.ndarray:
+    return (pred_proba > threshold).astype(np.uint8)
+
+def get_proba_tags() -> dict:
+    """
+    The thresholds of the prediction are stored with the probability map: segmentation probabilities are only
+    available for windows whose classification score exceeded the classification threshold at that time.
+    """
+    return {'class_th': cfg.PRED_CLASS_TH, 'segment_th': cfg.PRED_SEGMENT_TH, 'scale': cfg.PRED_PROBA_SCALE}
+
+def check_proba_thresholds(proba_tif_ds: DatasetReader, class_th: float) -> None:
+    pred_class_th = float(proba_tif_ds.tags()['class_th'])
+    if class_th < pred_class_th:
+        raise ValueError(f'The classification threshold ({class_th}) cannot be lower than the threshold the probability '
+                         f'map has been predicted with ({pred_class_th}), since windows below it were not segmented.')
+
+def get_pred_mask_from_proba(pred_proba: np.ndarray, class_th: float = cfg.PRED_CLASS_TH,
+                             segment_th: float = cfg.PRED_SEGMENT_TH, scale: int = cfg.PRED_PROBA_SCALE) -> np.ndarray:
+    """
+    Threshold (a block of) a probability map of shape (2, height, width) into a compact mask. A pixel is positive if
+    its merged segmentation probability and the maximum classification score of all windows covering it exceed the
+    thresholds. This is exact for the segmentation threshold, while for a raised classification threshold it
+    approximates the prediction where overlapping windows are on different sides of the threshold. Thresholds which
+    are no multiple of 1 / scale are effectively rounded down to the next multiple.
+    """
+    segment_proba, class_proba = pred_proba
+    pred_mask = ((segment_proba > segment_th * scale) & (class_proba > class_th * scale)).astype(np.uint8)
+    pred_mask[segment_proba == cfg.PRED_MASK_NODATA] = cfg.PRED_MASK_NODATA
+    return pred_mask
@@ -0,0 +1,91 @@
+import json
+import math
+import numpy as np
+import geopandas as gpd
+from rasterio import DatasetReader
+from loguru import logger
+import config as cfg
+from db import get_model_column_for_mapped_name
+from building.cache import get_single_img_buildings
+from images.models import ImgWindowClips
+from images.utils import get_results_file_path
+
+
+def get_windows_with_buildings(window_clips: gpd.GeoDataFrame, buildings_gdf: gpd.GeoDataFrame) -> np.ndarray:
+    """
+    Flag all windows intersecting with at least one building footprint.
+    """
+    has_buildings = np.zeros(len(window_clips), dtype=bool)
+    if len(buildings_gdf) > 0:
+        window_idx, _ = buildings_gdf.sindex.query(
+            window_clips[cfg.COL_GEOMETRY].to_crs(buildings_gdf.crs), predicate='intersects')
+        has_buildings[window_idx] = True
+    return has_buildings
+
+def get_windows_with_content(window_clips: gpd.GeoDataFrame, img_tif_ds: DatasetReader,
+                             decimation: int = cfg.PRUNING_DECIMATION) -> np.ndarray:
+    """
+    Flag all windows which are neither completely nodata nor homogeneous (i.e. the standard deviation of all valid
+    pixels is below the threshold in all bands).
+    The test is performed on a decimated version of the image (read from its overviews if available) for which the
+    pixel statistics of all windows are computed at once from summed-area tables.
+    """
+    height, width = math.ceil(img_tif_ds.height / decimation), math.ceil(img_tif_ds.width / decimation)
+    img = img_tif_ds.read(out_shape=(img_tif_ds.count, height, width))
+    nodata = img_tif_ds.nodata if img_tif_ds.nodata is not None else 0
+    valid = np.any(img != nodata, axis=0)
+
+    row_min = window_clips[get_model_column_for_mapped_name(ImgWindowClips, 'row_offset')].to_numpy() // decimation
+    col_min = window_clips[get_model_column_for_mapped_name(ImgWindowClips, 'column_offset')].to_numpy() // decimation
+    row_max = np.minimum(row_min + math.ceil(cfg.IMSIZE_MODEL_IN / decimation), height)
+    col_max = np.minimum(col_min + math.ceil(cfg.IMSIZE_MODEL_IN / decimation), width)
+
+    def get_window_sums(values: np.ndarray) -> np.ndarray:
+        summed_area = np.zeros((height + 1, width + 1))
+        summed_area[1:, 1:] = values.cumsum(axis=0).cumsum(axis=1)
+        return (summed_area[row_max, col_max] - summed_area[row_min, col_max]
+                - summed_area[row_max, col_min] + summed_area[row_min, col_min])
+
+    n_valid = get_window_sums(valid)
+    has_content = np.zeros(len(window_clips), dtype=bool)
+    for band in img:
+        band = np.where(valid, band, 0).astype(np.float64)
+        mean = get_window_sums(band) / np.maximum(n_valid, 1)
+        variance = get_window_sums(band ** 2) / np.maximum(n_valid, 1) - mean ** 2
+        has_content |= np.sqrt(np.maximum(variance, 0)) >= cfg.PRUNING_HOMOGENEITY_STD
+    return has_content & (n_valid > 0)
+
+def get_non_redundant_windows(window_clips: gpd.GeoDataFrame, img_tif_ds: DatasetReader) -> np.ndarray:
+    """
+    Windows at the bottom and right boundary of the image are padded with zeros (see fill_img_clip_boundary).
+    If the part of such a window inside the image is completely covered by the preceding window of the grid, it is
+    redundant.
+    """
+    row_off = window_clips[get_model_column_for_mapped_name(ImgWindowClips, 'row_offset')].to_numpy()
+    col_off = window_clips[get_model_column_for_mapped_name(ImgWindowClips, 'column_offset')].to_numpy()
+    redundant_rows = (row_off >= cfg.STRIDE) & (row_off - cfg.STRIDE + cfg.IMSIZE_MODEL_IN >= img_tif_ds.height)
+    redundant_cols = (col_off >= cfg.STRIDE) & (col_off - cfg.STRIDE + cfg.IMSIZE_MODEL_IN >= img_tif_ds.width)
+    return ~(redundant_rows | redundant_cols)
+
+def get_relevant_windows(img_name: str, window_clips: gpd.GeoDataFrame, img_tif_ds: DatasetReader) -> np.ndarray:
+    """
+    Flag all windows which need to be processed: windows containing buildings and image content which are not
+    redundant. The number of skipped windows per criterion is persisted to the results directory.
+    """
+    has_buildings = get_windows_with_buildings(window_clips, get_single_img_buildings(img_name))
+    has_content = get_windows_with_content(window_clips, img_tif_ds)
+    non_redundant = get_non_redundant_windows(window_clips, img_tif_ds)
+    relevant = has_buildings & has_content & non_redundant
+
+    pruning_stats = {
+        'n_windows': len(window_clips),
+        'n_wo_buildings': int(np.count_nonzero(~has_buildings)),
+        'n_wo_content': int(np.count_nonzero(~has_content)),
+        'n_redundant': int(np.count_nonzero(~non_redundant)),
+        'n_relevant': int(np.count_nonzero(relevant)),
+        'skip_ratio': float(1 - np.count_nonzero(relevant) / len(window_clips)) if len(window_clips) > 0 else 0.0
+    }
+    logger.info(f'Window pruning for {img_name}: {pruning_stats}')
+    with open(get_results_file_path(cfg.DIR_NAME_RESULTS_PRUNING, f'{img_name}.json'), 'w') as f:
+        json.dump(pruning_stats, f)
+    return relevant
@@ -0,0 +1,133 @@
+import argparse
+from typing import Iterator, List
+import numpy as np
+import pandas as pd
+import torch
+from loguru import logger
+import config as cfg
+from db import get_model_column_for_mapped_name
+from images.models import ImgMetadata, ImgWindowClips
+from images.utils import get_window_from_dict, get_img_tif_ds_reader_from_dir, get_results_file_path
+from images.data.models.quantization import quantize_model
+from images.prediction.engine import QuantizedEngine, build_model, get_inference_engines
+from images.prediction.tiles import StreamingTileSource
+from images.prediction.main import (
+    DEVICE, get_sorted_img_window_clips, predict_img_window_clips, read_window_clips, get_tensor_from_np_img_batch,
+    run_classification_for_batch)
+from logs.utils import start_logging
+
+
+def sample_img_names(n_imgs: int, seed: int) -> List[str]:
+    img_names = ImgMetadata.get_all()[get_model_column_for_mapped_name(ImgMetadata, 'img_name')]
+    return img_names.sample(n=min(n_imgs, len(img_names)), random_state=seed).tolist()
+
+def get_calibration_clips(img_names: List[str], n_clips: int, seed: int) -> torch.Tensor:
+    """
+    Sample window clips evenly across the given images and return them normalized as a single tensor.
+    """
+    clips = []
+    for img_name in img_names:
+        window_clips = get_sorted_img_window_clips(img_name)
+        window_clips = window_clips.sample(n=min(n_clips // len(img_names), len(window_clips)), random_state=seed)
+        window_clips = window_clips.sort_values(by=[
+            get_model_column_for_mapped_name(ImgWindowClips, 'row_offset'),
+            get_model_column_for_mapped_name(ImgWindowClips, 'column_offset')])
+        tile_source = StreamingTileSource(get_img_tif_ds_reader_from_dir(cfg.DIR_PATH_IMG_DATA, img_name))
+        windows = [get_window_from_dict(window_dict) for window_dict in window_clips.to_dict('records')]
+        clips.extend(read_window_clips(tile_source, windows))
+    return get_tensor_from_np_img_batch(clips).cpu()
+
+def get_calibration_batches(clips: torch.Tensor, batch_size: int) -> Iterator[torch.Tensor]:
+    return (clips[i:i + batch_size] for i in range(0, len(clips), batch_size))
+
+def calibrate_quantized_models(img_names: List[str], n_clips: int, batch_size: int, seed: int) -> None:
+    """
+    The classifier is calibrated on all sampled clips. As the segmenter only processes clips passing the
+    classification threshold, it is calibrated on the positive clips only (unless there are too few of them).
+    """
+    clips = get_calibration_clips(img_names, n_clips, seed)
+    classifier, segmenter = build_model('classifier'), build_model('segmenter')
+    pred_class = np.concatenate([run_classification_for_batch(classifier, batch)
+                                 for batch in get_calibration_batches(clips, batch_size)])
+    positive_clips = clips[torch.from_numpy(np.flatnonzero(pred_class > cfg.PRED_CLASS_TH))]
+    if len(positive_clips) < batch_size:
+        logger.warning(f'Only {len(positive_clips)} of {len(clips)} calibration clips are classified as positive: '
+                       f'calibrating the segmenter on all clips.')
+        positive_clips = clips
+    logger.info(f'Calibrating quantized models on {len(clips)} clips ({len(positive_clips)} for the segmenter).')
+
+    QuantizedEngine.export('classifier', quantize_model(classifier, get_calibration_batches(clips, batch_size)))
+    QuantizedEngine.export('segmenter', quantize_model(segmenter, get_calibration_batches(positive_clips, batch_size)))
+    get_inference_engines.cache_clear()
+
+def compare_pred_masks(pred_mask_fp32: np.ndarray, pred_mask_int8: np.ndarray, sqm_per_px: float) -> dict:
+    detections_fp32, detections_int8 = pred_mask_fp32 == 1, pred_mask_int8 == 1
+    union = np.count_nonzero(detections_fp32 | detections_int8)
+    area_fp32 = np.count_nonzero(detections_fp32) * sqm_per_px
+    area_int8 = np.count_nonzero(detections_int8) * sqm_per_px
+    return {
+        'iou': np.count_nonzero(detections_fp32 & detections_int8) / union if union > 0 else 1.0,
+        'area_fp32_sqm': area_fp32,
+        'area_int8_sqm': area_int8,
+        'area_delta_sqm': area_int8 - area_fp32,
+        'area_delta_rel': (area_int8 - area_fp32) / area_fp32 if area_fp32 > 0 else np.nan
+    }
+
+def create_comparison_report(img_names: List[str], batch_size: int) -> pd.DataFrame:
+    """
+    Compare the prediction masks of the quantized models to those of the full precision models per image:
+    the IoU of the detected pixels and the difference of the detected area.
+    """
+    report = []
+    for img_name in img_names:
+        tif_ds_reader = get_img_tif_ds_reader_from_dir(cfg.DIR_PATH_IMG_DATA, img_name)
+        window_clips = get_sorted_img_window_clips(img_name)
+        pred_masks = {backend: predict_img_window_clips(
+            window_clips, tif_ds_reader, get_inference_engines(backend, DEVICE), batch_size=batch_size)['pred_mask']
+            for backend in ['eager', 'int8']}
+        sqm_per_px = abs(tif_ds_reader.transform.a * tif_ds_reader.transform.e)
+        report.append({get_model_column_for_mapped_name(ImgMetadata, 'img_name'): img_name,
+                       **compare_pred_masks(pred_masks['eager'], pred_masks['int8'], sqm_per_px)})
+        logger.info(f'Quantization report for {img_name}: {report[-1]}')
+    report_df = pd.DataFrame(report)
+    report_df.to_csv(get_results_file_path(cfg.DIR_NAME_RESULTS_QUANTIZATION, 'report.csv'), index=False)
+    return report_df
+
+def main(n_calibration_imgs: int = cfg.QUANT_CALIBRATION_IMGS, n_calibration_clips: int = cfg.QUANT_CALIBRATION_CLIPS,
+         n_report_imgs: int = cfg.QUANT_REPORT_IMGS, batch_size: int = cfg.PRED_BATCH_SIZE, seed: int = 0) -> None:
+    calibration_img_names = sample_img_names(n_calibration_imgs, seed)
+    calibrate_quantized_models(calibration_img_names, n_calibration_clips, batch_size, seed)
+    if n_report_imgs > 0:
+        create_comparison_report(sample_img_names(n_report_imgs, seed + 1), batch_size)
+
+
+if __name__ == "__main__":
+    start_logging(__file__)
+
+    parser = argparse.ArgumentParser(
+        description='Calibrate the INT8 quantized models and compare their predictions to the full precision models.')
+    parser.add_argument('--n_calibration_imgs',
+                        help='Specify the number of images from which calibration clips are sampled.',
+                        type=int,
+                        default=cfg.QUANT_CALIBRATION_IMGS)
+    parser.add_argument('--n_calibration_clips',
+                        help='Specify the total number of window clips used for calibration.',
+                        type=int,
+                        default=cfg.QUANT_CALIBRATION_CLIPS)
+    parser.add_argument('--n_report_imgs',
+                        help='Specify the number of images for which the predictions are compared. If 0, no report '
+                             'is created.',
+                        type=int,
+                        default=cfg.QUANT_REPORT_IMGS)
+    parser.add_argument('--batch_size',
+                        help='Specify the number of window clips that are stacked into a single batch for inference.',
+                        type=int,
+                        default=cfg.PRED_BATCH_SIZE)
+    parser.add_argument('--seed',
+                        help='Specify the random seed for sampling images and window clips.',
+                        type=int,
+                        default=0)
+    args = parser.parse_args()
+
+    main(n_calibration_imgs=args.n_calibration_imgs, n_calibration_clips=args.n_calibration_clips,
+         n_report_imgs=args.n_report_imgs, batch_size=args.batch_size, seed=args.seed)
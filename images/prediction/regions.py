@@ -0,0 +1,64 @@
+import math
+from typing import List
+import geopandas as gpd
+from rasterio.windows import Window
+import config as cfg
+from db import get_model_column_for_mapped_name
+from images.models import ImgWindowClips
+from images.utils import get_window_from_dict
+
+REGION_SIZE_MULTIPLE = 32  # the input size of the segmenter needs to be divisible by its total downsampling factor
+
+
+def get_region_cells(max_size: int) -> int:
+    """
+    Maximum number of windows per side of a region, such that the region does not exceed the maximum size.
+    """
+    return max(1, (max_size - cfg.IMSIZE_MODEL_IN) // cfg.STRIDE + 1)
+
+def get_positive_regions(window_clips: gpd.GeoDataFrame, pred_class: dict,
+                         max_size: int = cfg.PRED_REGION_MAX_SIZE) -> List[dict]:
+    """
+    Merge adjacent windows classified as positive into rectangular regions on the grid of window clips. Regions are
+    grown greedily in row-major order: first to the right, then downwards as long as all windows of the next row are
+    positive and not yet part of another region.
+    Each region is returned as a dict of its window (in the source image) and the windows it consists of.
+    """
+    idx_col = get_model_column_for_mapped_name(ImgWindowClips, 'index')
+    cells = {}
+    for window_dict in window_clips.to_dict('records'):
+        if pred_class.get(window_dict[idx_col], 0) > cfg.PRED_CLASS_TH:
+            cells[(window_dict[get_model_column_for_mapped_name(ImgWindowClips, 'row_offset')] // cfg.STRIDE,
+                   window_dict[get_model_column_for_mapped_name(ImgWindowClips, 'column_offset')] // cfg.STRIDE)] = \
+                window_dict
+
+    max_cells = get_region_cells(max_size)
+    regions = []
+    for row, col in sorted(cells):
+        if (row, col) not in cells:
+            continue
+        n_cols = 1
+        while n_cols < max_cells and (row, col + n_cols) in cells:
+            n_cols += 1
+        n_rows = 1
+        while n_rows < max_cells and all((row + n_rows, col + i) in cells for i in range(n_cols)):
+            n_rows += 1
+        region_cells = [(row + i, col + j) for i in range(n_rows) for j in range(n_cols)]
+        regions.append({
+            'window': Window(col * cfg.STRIDE, row * cfg.STRIDE, (n_cols - 1) * cfg.STRIDE + cfg.IMSIZE_MODEL_IN,
+                             (n_rows - 1) * cfg.STRIDE + cfg.IMSIZE_MODEL_IN),
+            'window_dicts': [cells.pop(cell) for cell in region_cells]
+        })
+    return regions
+
+def get_padded_region_shape(region: dict) -> tuple:
+    return tuple(math.ceil(size / REGION_SIZE_MULTIPLE) * REGION_SIZE_MULTIPLE
+                 for size in (region['window'].height, region['window'].width))
+
+def get_window_crop(region: dict, window_dict: dict) -> tuple:
+    """
+    Slices of a window within the region.
+    """
+    window = get_window_from_dict(window_dict)
+    row_min, col_min = window.row_off - region['window'].row_off, window.col_off - region['window'].col_off
+    return slice(row_min, row_min + window.height), slice(col_min, col_min + window.width)
@@ -0,0 +1,111 @@
+import argparse
+import os
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from sqlalchemy import delete
+from sqlalchemy.orm import Session
+from loguru import logger
+import config as cfg
+from db import engine, get_model_column_for_mapped_name, copy_to_postgis
+from logs.utils import start_logging
+from images.models import ImgMetadata, ImgWindowScores
+from images.utils import get_results_file_path
+from images.prediction.engine import get_model_file_path
+
+
+def get_score_store_file_path(img_name: str) -> str:
+    return get_results_file_path(cfg.DIR_NAME_RESULTS_PRED_CLASS, f'{img_name}.npz')
+
+def get_classifier_fingerprint(model: dict) -> str:
+    """
+    Stored scores are only reused for the same classifier, which is identified by its inference engine and the size and
+    modification time of its state dict.
+    """
+    fingerprint = type(model['classifier']).__name__
+    file_path = get_model_file_path('classifier')
+    if file_path.exists():
+        fingerprint += f':{file_path.stat().st_size}:{file_path.stat().st_mtime_ns}'
+    return fingerprint
+
+def get_score_store_fingerprint(img_name: str, model: dict) -> str:
+    """
+    Stored scores are only valid for the same classifier, image file (identified by the size and modification time
+    in the catalog) and window grid, since the scores are keyed by the window idx only.
+    """
+    with Session(engine) as session:
+        img_metadata = session.get(ImgMetadata, img_name)
+        img_fingerprint = None if img_metadata is None else f'{img_metadata.file_size}:{img_metadata.file_mtime}'
+    return f'{get_classifier_fingerprint(model)}|{img_fingerprint}|{cfg.STRIDE}:{cfg.IMSIZE_MODEL_IN}'
+
+def get_empty_scores() -> pd.DataFrame:
+    return pd.DataFrame({'idx': np.array([], dtype=np.int64), 'score': np.array([], dtype=np.float32),
+                         'gate': np.array([], dtype=bool), 'seconds': np.array([], dtype=np.float32)}).set_index('idx')
+
+def load_scores(img_name: str, fingerprint: str = None) -> pd.DataFrame:
+    """
+    Load the score store of an image as a frame of the score, gate decision and classification time (in seconds) per
+    window, indexed by the window idx. If a fingerprint is passed, stores of other classifiers, image files or window
+    grids (see: get_score_store_fingerprint) are ignored.
+    """
+    file_path = get_score_store_file_path(img_name)
+    if not os.path.exists(file_path):
+        return get_empty_scores()
+    with np.load(file_path) as store:
+        if fingerprint is not None and ('fingerprint' not in store.files or str(store['fingerprint']) != fingerprint):
+            logger.info(f'Ignoring stored scores for {img_name}: they have been predicted by a different classifier, '
+                        f'for a different image file or window grid.')
+            return get_empty_scores()
+        return pd.DataFrame({column: store[column] for column in ['idx', 'score', 'gate', 'seconds']}).set_index('idx')
+
+def write_scores(img_name: str, total_pred: dict, fingerprint: str, stored_scores: pd.DataFrame = None) -> None:
+    """
+    Write the scores of all predicted windows to a structured npz file, keeping stored scores of windows which have not
+    been predicted in this run (i.e. skipped by pruning). The classification time is NaN for windows restored from a
+    checkpoint. The file is written under a temporary name first.
+    """
+    scores = pd.DataFrame({
+        'idx': np.fromiter(total_pred['pred_class'].keys(), dtype=np.int64, count=len(total_pred['pred_class'])),
+        'score': np.fromiter(total_pred['pred_class'].values(), dtype=np.float32, count=len(total_pred['pred_class']))
+    }).set_index('idx')
+    scores['gate'] = scores['score'] > cfg.PRED_CLASS_TH
+    scores['seconds'] = scores.index.map(total_pred['pred_seconds']).astype(np.float32)
+    if stored_scores is not None:
+        scores = pd.concat([stored_scores[~stored_scores.index.isin(scores.index)], scores]).sort_index()
+    tmp_file_path = f'{get_score_store_file_path(img_name)}.tmp'
+    with open(tmp_file_path, 'wb') as f:
+        np.savez(f, idx=scores.index.to_numpy(np.int64), score=scores['score'].to_numpy(np.float32),
+                 gate=scores['gate'].to_numpy(bool), seconds=scores['seconds'].to_numpy(np.float32),
+                 fingerprint=np.array(fingerprint))
+    os.replace(tmp_file_path, get_score_store_file_path(img_name))
+
+def load_scores_to_db(img_name: str) -> None:
+    """
+    Replace the scores of the image in the DB by the score store in a single bulk load.
+    """
+    scores = load_scores(img_name).reset_index().rename(columns={
+        'idx': get_model_column_for_mapped_name(ImgWindowScores, 'index')})
+    scores[get_model_column_for_mapped_name(ImgWindowScores, 'img_name')] = img_name
+    with Session(engine) as session:
+        session.execute(delete(ImgWindowScores).where(ImgWindowScores.img_name == img_name))
+        session.commit()
+    copy_to_postgis(
+        scores,
+        name=ImgWindowScores.__tablename__,
+        schema=ImgWindowScores.__table_args__['schema'],
+        if_exists='append')
+
+def main() -> None:
+    img_names = sorted(file_path.stem for file_path in
+                       Path(get_results_file_path(cfg.DIR_NAME_RESULTS_PRED_CLASS)).glob('*.npz'))
+    for img_name in img_names:
+        load_scores_to_db(img_name)
+        logger.info(f'Loaded scores of {img_name} to the DB.')
+
+if __name__ == "__main__":
+    start_logging(__file__)
+
+    parser = argparse.ArgumentParser(description='Load the stored classifier scores of all images to the DB.')
+    parser.parse_args()
+
+    main()
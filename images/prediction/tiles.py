@@ -0,0 +1,73 @@
+import math
+import numpy as np
+from rasterio import DatasetReader
+from rasterio.windows import Window
+import config as cfg
+from images.utils import get_img
+
+
+class InMemoryTileSource:
+    """
+    Serves window clips from an image that is fully loaded into memory.
+    """
+
+    def __init__(self, img: np.ndarray) -> None:
+        self.img = img
+
+    @classmethod
+    def from_tif_ds(cls, img_tif_ds: DatasetReader) -> 'InMemoryTileSource':
+        return cls(get_img(img_tif_ds))
+
+    def read(self, window: Window) -> np.ndarray:
+        return self.img[:, window.row_off:(window.row_off + window.height), window.col_off:(window.col_off + window.width)]
+
+
+class StreamingTileSource:
+    """
+    Serves window clips via windowed reads instead of loading the entire image into memory.
+    The image is read in full-width bands of rows which are aligned to the internal block layout of the file.
+    Only the rows still needed by the current window are cached: if windows are requested in row-major order, each
+    row is read exactly once although consecutive rows of windows overlap by the stride.
+    Windows which lie above the cached band (i.e. requested out of order) are read directly from the file.
+    """
+
+    def __init__(self, img_tif_ds: DatasetReader) -> None:
+        self.img_tif_ds = img_tif_ds
+        block_height = img_tif_ds.block_shapes[0][0]
+        self.rows_per_read = max(block_height, math.ceil(cfg.STRIDE / block_height) * block_height)
+        self.band = np.empty((img_tif_ds.count, 0, img_tif_ds.width), dtype=img_tif_ds.dtypes[0])
+        self.band_row_off = 0
+
+    def read(self, window: Window) -> np.ndarray:
+        row_min = window.row_off
+        row_max = min(window.row_off + window.height, self.img_tif_ds.height)
+        col_max = min(window.col_off + window.width, self.img_tif_ds.width)
+        if row_min < self.band_row_off:
+            return self.img_tif_ds.read(window=Window(window.col_off, row_min, col_max - window.col_off, row_max - row_min))
+        self._update_band(row_min, row_max)
+        return self.band[:, (row_min - self.band_row_off):(row_max - self.band_row_off), window.col_off:col_max]
+
+    def _update_band(self, row_min: int, row_max: int) -> None:
+        """
+        Drop all cached rows above the requested window and extend the band by block-aligned reads until it covers
+        the requested window.
+        """
+        band_row_max = self.band_row_off + self.band.shape[1]
+        if row_min >= band_row_max:
+            self.band = self.band[:, :0]
+            self.band_row_off = row_min - row_min % self.rows_per_read
+        else:
+            first_row_needed = row_min - row_min % self.rows_per_read
+            self.band = self.band[:, (first_row_needed - self.band_row_off):]
+            self.band_row_off = first_row_needed
+        band_row_max = self.band_row_off + self.band.shape[1]
+        if row_max > band_row_max:
+            read_row_max = min(self.img_tif_ds.height,
+                               math.ceil(row_max / self.rows_per_read) * self.rows_per_read)
+            rows = self.img_tif_ds.read(
+                window=Window(0, band_row_max, self.img_tif_ds.width, read_row_max - band_row_max))
+            self.band = np.concatenate([self.band, rows], axis=1)
+
+
+def get_tile_source(img_tif_ds: DatasetReader, stream_tiles: bool = cfg.PRED_STREAM_TILES):
+    return StreamingTileSource(img_tif_ds) if stream_tiles else InMemoryTileSource.from_tif_ds(img_tif_ds)
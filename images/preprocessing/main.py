@@ -1,36 +1,70 @@
-import itertools
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
-from db import engine, get_model_column_for_mapped_name
+import shapely
+from sqlalchemy import delete, exists, select
+from sqlalchemy.orm import Session
+from db import engine, get_model_column_for_mapped_name, copy_to_postgis
 from logs.utils import start_logging
 from pathlib import Path
-from typing import List
+from typing import List, Union
 import geopandas as gpd
 import rasterio
 from rasterio.windows import Window
 import config as cfg
-from images import ImgMetadata, ImgWindowClips, get_window_from_dict, get_img_tif_ds_reader_from_dir
+from images import ImgMetadata, ImgWindowClips, ImgWindowGrids, get_img_tif_ds_reader_from_dir
+from ledger.utils import get_fingerprint, is_stage_current, record_stage
 from shapely.geometry import box
 from loguru import logger
 
+STAGE = 'preprocessing'
 
-def get_img_metadata_from_tif_files(dir_path: str) -> gpd.GeoDataFrame:
+
+def get_img_metadata_from_tif_files(dir_path: str, src_files: List[Path] = None,
+                                    num_threads: int = cfg.CATALOG_NUM_THREADS) -> gpd.GeoDataFrame:
+    """
+    The headers of all files (or only the given files) are read by parallel threads, since reading them is dominated
+    by I/O.
+    """
     if type(dir_path) == str:
         dir_path = Path(dir_path)
-    src_files = get_tif_files_in_dir(dir_path)
-    metadata_dict_list = []
-    for file in src_files:
-        img_tif_ds = rasterio.open(file)
-        file_dict = {
-            get_model_column_for_mapped_name(ImgMetadata, 'img_name'): file.name.replace('.tif', ''),
-            cfg.COL_GEOMETRY: get_polygon_from_boundary_coords(
-                bottom_left=f"{img_tif_ds.bounds.left}:{img_tif_ds.bounds.bottom}",
-                top_right=f"{img_tif_ds.bounds.right}:{img_tif_ds.bounds.top}"),
-            get_model_column_for_mapped_name(ImgMetadata, 'dir_path'): dir_path.__str__(),
-            get_model_column_for_mapped_name(ImgMetadata, 'file_path'): file.name
-        }
-        metadata_dict_list.append(file_dict)
+    src_files = get_tif_files_in_dir(dir_path) if src_files is None else src_files
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        metadata_dict_list = list(executor.map(lambda file: get_img_metadata_from_tif_file(file, dir_path), src_files))
     return get_gdf_from_dict(metadata_dict_list)
 
+def get_img_metadata_from_tif_file(file: Path, dir_path: Path) -> dict:
+    with rasterio.open(file) as img_tif_ds:
+        bounds = img_tif_ds.bounds
+    return {
+        get_model_column_for_mapped_name(ImgMetadata, 'img_name'): file.name.replace('.tif', ''),
+        cfg.COL_GEOMETRY: get_polygon_from_boundary_coords(bottom_left=f"{bounds.left}:{bounds.bottom}",
+                                                           top_right=f"{bounds.right}:{bounds.top}"),
+        get_model_column_for_mapped_name(ImgMetadata, 'dir_path'): dir_path.__str__(),
+        get_model_column_for_mapped_name(ImgMetadata, 'file_path'): file.name,
+        **get_tif_file_fingerprint(file)
+    }
+
+def get_tif_file_fingerprint(file: Path) -> dict:
+    stat = file.stat()
+    return {get_model_column_for_mapped_name(ImgMetadata, 'file_size'): stat.st_size,
+            get_model_column_for_mapped_name(ImgMetadata, 'file_mtime'): stat.st_mtime_ns}
+
+def get_new_or_changed_tif_files(dir_path: Path, catalog_df: pd.DataFrame) -> List[Path]:
+    """
+    Files are identified by their path and considered as changed if their size or modification time differs from the
+    catalog (only the file system metadata is compared, the files are not opened).
+    """
+    catalog = {
+        (row[get_model_column_for_mapped_name(ImgMetadata, 'dir_path')],
+         row[get_model_column_for_mapped_name(ImgMetadata, 'file_path')]):
+            (row[get_model_column_for_mapped_name(ImgMetadata, 'file_size')],
+             row[get_model_column_for_mapped_name(ImgMetadata, 'file_mtime')])
+        for row in catalog_df.to_dict('records')}
+    return [file for file in get_tif_files_in_dir(dir_path)
+            if catalog.get((dir_path.__str__(), file.name)) != tuple(get_tif_file_fingerprint(file).values())]
+
 def get_tif_files_in_dir(dir_path: Path) -> List[Path]:
     return list(dir_path.glob('**/*.tif'))
 
@@ -46,20 +80,35 @@ def get_polygon_from_boundary_coords(bottom_left: str, top_right: str) -> box:
                maxy=float(top_right.split(":")[1]),
                ccw=True)
 
+def get_window_grid_offsets(shape: tuple, stride: int = cfg.STRIDE) -> tuple:
+    """
+    Row and column offsets of all windows of the grid in row-major order.
+    """
+    row_off, col_off = np.meshgrid(np.arange(0, shape[0], stride), np.arange(0, shape[1], stride), indexing='ij')
+    return row_off.ravel(), col_off.ravel()
+
 def set_img_window_clips_gdf(img_tif_ds: rasterio.DatasetReader, img_name: str) -> gpd.GeoDataFrame:
-    clips = []
     try:
-        for y, x in itertools.product(range(0, img_tif_ds.shape[0], cfg.STRIDE), range(0, img_tif_ds.shape[1], cfg.STRIDE)):
-            window = {'col_off': x, 'row_off': y, 'width': cfg.IMSIZE_MODEL_IN, 'height': cfg.IMSIZE_MODEL_IN}
-            clips.append(window)
+        row_off, col_off = get_window_grid_offsets(img_tif_ds.shape)
+        clips = pd.DataFrame({'col_off': col_off, 'row_off': row_off, 'width': cfg.IMSIZE_MODEL_IN,
+                              'height': cfg.IMSIZE_MODEL_IN})
         return get_gdf_from_img_window_clips(clips=clips, img_tif_ds=img_tif_ds, img_name=img_name)
     except AttributeError as ae:
         logger.error(ae)
 
-def get_gdf_from_img_window_clips(clips: list, img_tif_ds: rasterio.DatasetReader, img_name: str) -> gpd.GeoDataFrame:
+def get_window_boxes(clips: pd.DataFrame, img_tif_ds: rasterio.DatasetReader) -> np.ndarray:
+    """
+    Vectorized version of `rasterio.windows.bounds`: the bounds of all windows are computed at once by applying the
+    affine transform of the image to arrays of their corners and converted to boxes in bulk.
+    """
+    left, bottom = img_tif_ds.transform * (clips['col_off'].to_numpy(), (clips['row_off'] + clips['height']).to_numpy())
+    right, top = img_tif_ds.transform * ((clips['col_off'] + clips['width']).to_numpy(), clips['row_off'].to_numpy())
+    return shapely.box(left, bottom, right, top, ccw=True)
+
+def get_gdf_from_img_window_clips(clips: Union[list, pd.DataFrame], img_tif_ds: rasterio.DatasetReader,
+                                  img_name: str) -> gpd.GeoDataFrame:
     df = pd.DataFrame(clips)
-    df[cfg.COL_GEOMETRY] = df.apply(
-        lambda x: box(*rasterio.windows.bounds(get_window_from_dict(x), img_tif_ds.transform), ccw=True), axis=1)
+    df[cfg.COL_GEOMETRY] = get_window_boxes(df, img_tif_ds)
     df[get_model_column_for_mapped_name(ImgWindowClips, 'img_name')] = img_name
     gdf = gpd.GeoDataFrame(df, geometry=cfg.COL_GEOMETRY, crs=img_tif_ds.crs)
     gdf.to_crs(crs=f"EPSG:{cfg.EPSG_TARGET}", inplace=True)
@@ -71,36 +120,130 @@ def get_gdf_from_img_window_clips(clips: list, img_tif_ds: rasterio.DatasetReade
         gdf.reset_index(inplace=True)
     return gdf
 
-def fill_img_metadata_table() -> None:
-    metadata_df = get_img_metadata_from_tif_files(cfg.DIR_PATH_IMG_DATA)
-    metadata_df.to_postgis(
-        con=engine,
+def fill_img_metadata_table(incremental: bool = cfg.CATALOG_INCREMENTAL) -> List[str]:
+    """
+    Catalog all images in the image directory and return the names of all new or changed images. If incremental, only
+    the headers of new or changed images are read.
+    """
+    dir_path = Path(cfg.DIR_PATH_IMG_DATA)
+    src_files = get_new_or_changed_tif_files(dir_path, ImgMetadata.get_all()) if incremental else \
+        get_tif_files_in_dir(dir_path)
+    logger.info(f'Cataloging {len(src_files)} new or changed images.')
+    if len(src_files) == 0:
+        return []
+    metadata_df = get_img_metadata_from_tif_files(dir_path, src_files)
+    # new images are inserted and changed images (identified by their name) are updated
+    copy_to_postgis(
+        metadata_df,
         name=ImgMetadata.__tablename__,
         schema=ImgMetadata.__table_args__['schema'],
-        if_exists='replace',
-        index=False,
-        chunksize=100)
+        if_exists='upsert')
+    return metadata_df[get_model_column_for_mapped_name(ImgMetadata, 'img_name')].tolist()
+
+def delete_img_window_clips(img_names: List[str]) -> None:
+    """
+    Window clips (or grids) of changed images are replaced. Predictions of changed images are outdated by their file
+    fingerprint (see: ledger).
+    """
+    with Session(engine) as session:
+        session.execute(delete(ImgWindowClips).where(ImgWindowClips.img_name.in_(img_names)))
+        session.execute(delete(ImgWindowGrids).where(ImgWindowGrids.img_name.in_(img_names)))
+        session.commit()
 
-def fill_img_window_clips_table() -> None:
+def get_img_window_grid_df(img_tif_ds: rasterio.DatasetReader, img_name: str) -> pd.DataFrame:
+    """
+    Only the parameters required to derive all window clips of the image (see: ImgWindowGrids).
+    """
+    return pd.DataFrame([{
+        get_model_column_for_mapped_name(ImgWindowGrids, 'img_name'): img_name,
+        get_model_column_for_mapped_name(ImgWindowGrids, 'height'): img_tif_ds.height,
+        get_model_column_for_mapped_name(ImgWindowGrids, 'width'): img_tif_ds.width,
+        get_model_column_for_mapped_name(ImgWindowGrids, 'stride'): cfg.STRIDE,
+        get_model_column_for_mapped_name(ImgWindowGrids, 'size'): cfg.IMSIZE_MODEL_IN,
+        get_model_column_for_mapped_name(ImgWindowGrids, 'transform'): list(img_tif_ds.transform)[:6],
+        get_model_column_for_mapped_name(ImgWindowGrids, 'srid'): img_tif_ds.crs.to_epsg()
+    }])
+
+def get_tiling_fingerprint(img_metadata: pd.Series, storage: str) -> str:
+    return get_fingerprint(
+        img_metadata[get_model_column_for_mapped_name(ImgMetadata, 'file_path')],
+        img_metadata[get_model_column_for_mapped_name(ImgMetadata, 'file_size')],
+        img_metadata[get_model_column_for_mapped_name(ImgMetadata, 'file_mtime')],
+        cfg.STRIDE, cfg.IMSIZE_MODEL_IN, storage)
+
+def tiling_exists(img_name: str, storage: str) -> bool:
+    model = ImgWindowGrids if storage == 'virtual' else ImgWindowClips
+    with Session(engine) as session:
+        return session.execute(select(exists().where(model.img_name == img_name))).scalar()
+
+def get_img_names_to_tile(storage: str, changed_img_names: List[str]) -> List[str]:
+    """
+    Images are (re-)tiled if they are new or changed or if their tiling is not current according to the ledger (e.g.
+    after the stride or the storage have been changed, a failed run or an invalidation). Images tiled before the ledger
+    existed are adopted if their window clips (or grid) exist.
+    """
+    img_names = []
+    for img_name, img_metadata in ImgMetadata.get_all().set_index(
+            get_model_column_for_mapped_name(ImgMetadata, 'img_name')).iterrows():
+        if img_name in changed_img_names or not is_stage_current(
+                img_name, STAGE, get_tiling_fingerprint(img_metadata, storage),
+                lambda: tiling_exists(img_name, storage)):
+            img_names.append(img_name)
+    return img_names
+
+def fill_img_window_clips_table(storage: str = cfg.WINDOW_CLIPS_STORAGE, img_names: List[str] = None) -> None:
+    """
+    Virtual window clips are only stored as grid parameters per image, from which they are derived by a view (see:
+    ImgWindowGrids).
+    If image names are passed, only these images are (re-)tiled. The tiling of each image is recorded in the ledger.
+    """
     metadata_df = ImgMetadata.get_all()
+    if img_names is not None:
+        metadata_df = metadata_df[metadata_df[get_model_column_for_mapped_name(ImgMetadata, 'img_name')].isin(img_names)]
+        delete_img_window_clips(img_names)
     for img_metadata in metadata_df.iterrows():
         tif_ds_reader = get_img_tif_ds_reader_from_dir(cfg.DIR_PATH_IMG_DATA, img_metadata[1][
             get_model_column_for_mapped_name(ImgMetadata, 'file_path')])
-        window_clips = set_img_window_clips_gdf(img_tif_ds=tif_ds_reader, img_name=img_metadata[1][
-            get_model_column_for_mapped_name(ImgMetadata, 'img_name')])
-        window_clips.to_postgis(
-            con=engine,
-            name=ImgWindowClips.__tablename__,
-            schema=ImgWindowClips.__table_args__['schema'],
-            if_exists='append',
-            index=False,
-            chunksize=100)
+        img_name = img_metadata[1][get_model_column_for_mapped_name(ImgMetadata, 'img_name')]
+        with record_stage(img_name, STAGE, get_tiling_fingerprint(img_metadata[1], storage)) as stage:
+            if storage == 'virtual':
+                copy_to_postgis(
+                    get_img_window_grid_df(img_tif_ds=tif_ds_reader, img_name=img_name),
+                    name=ImgWindowGrids.__tablename__,
+                    schema=ImgWindowGrids.__table_args__['schema'],
+                    if_exists='append')
+                stage['n_rows'] = 1
+                continue
+            window_clips = set_img_window_clips_gdf(img_tif_ds=tif_ds_reader, img_name=img_name)
+            copy_to_postgis(
+                window_clips,
+                name=ImgWindowClips.__tablename__,
+                schema=ImgWindowClips.__table_args__['schema'],
+                if_exists='append')
+            stage['n_rows'] = len(window_clips)
 
-def main() -> None:
-    fill_img_metadata_table()
-    fill_img_window_clips_table()
+def main(window_clips_storage: str = cfg.WINDOW_CLIPS_STORAGE, incremental: bool = cfg.CATALOG_INCREMENTAL) -> None:
+    img_names = fill_img_metadata_table(incremental=incremental)
+    if incremental:
+        img_names = get_img_names_to_tile(window_clips_storage, img_names)
+    if len(img_names) > 0:
+        fill_img_window_clips_table(storage=window_clips_storage, img_names=img_names)
 
 
 if __name__ == "__main__":
     start_logging(__file__)
-    main()
+
+    parser = argparse.ArgumentParser(description='Extract image metadata and window clips.')
+    parser.add_argument('--window_clips_storage',
+                        help='Specify whether all window clips are written to a table or only the parameters of the '
+                             'window grid per image, from which the window clips are derived by a view (virtual).',
+                        choices=['table', 'virtual'],
+                        default=cfg.WINDOW_CLIPS_STORAGE)
+    parser.add_argument('--incremental',
+                        help='Specify whether only new or changed images (by path, size and modification time) should '
+                             'be cataloged and tiled instead of all images.',
+                        action=argparse.BooleanOptionalAction,
+                        default=cfg.CATALOG_INCREMENTAL)
+    args = parser.parse_args()
+
+    main(window_clips_storage=args.window_clips_storage, incremental=args.incremental)
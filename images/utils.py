@@ -4,8 +4,12 @@ import numpy as np
 from pathlib import Path
 import config as cfg
 import os
+from typing import List, Tuple, Union
 
 MEAN, STD = [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
+# normalization folded into a single scale and offset per channel: (x / 255 - MEAN) / STD = x * SCALE + OFFSET
+NORM_SCALE = (1 / (255 * np.array(STD))).astype(np.float32).reshape(-1, 1, 1)
+NORM_OFFSET = (-np.array(MEAN) / np.array(STD)).astype(np.float32).reshape(-1, 1, 1)
 
 def get_window_from_dict(window_dict: dict) -> Window:
     return rasterio.windows.Window(col_off=window_dict['col_off'],
@@ -50,3 +54,25 @@ def normalize(image: np.ndarray) -> np.ndarray:
 
     # moveaxis for array broadcasting, and then back so its how pytorch expects it
     return np.moveaxis((np.moveaxis(image, source, dest) - MEAN) / STD, dest, source)
+
+class BatchNormalizer:
+    """Normalizes a batch of images like `normalize`, but in float32 and into a preallocated buffer which is reused
+    for every batch. The returned array is a view of the buffer, i.e. it is overwritten by the next call.
+
+    Images smaller than the buffer (i.e. window clips at the image boundary) are padded with zeros before
+    normalization, analogously to `fill_img_clip_boundary`.
+    """
+
+    def __init__(self, batch_size: int, size: Union[int, Tuple[int, int]] = cfg.IMSIZE_MODEL_IN) -> None:
+        height, width = (size, size) if isinstance(size, int) else size
+        self.buffer = np.empty((batch_size, len(MEAN), height, width), dtype=np.float32)
+
+    def __call__(self, images: List[np.ndarray]) -> np.ndarray:
+        batch = self.buffer[:len(images)]
+        for image, normalized in zip(images, batch):
+            height, width = image.shape[1:]
+            np.multiply(image, NORM_SCALE, out=normalized[:, :height, :width])
+            normalized[:, :height, :width] += NORM_OFFSET
+            normalized[:, height:, :] = NORM_OFFSET
+            normalized[:, :height, width:] = NORM_OFFSET
+        return batch
@@ -0,0 +1,38 @@
+import argparse
+from typing import List
+from loguru import logger
+from db import get_model_column_for_mapped_name
+from images import ImgMetadata
+from logs.utils import start_logging
+from ledger.utils import STAGES, invalidate_stages, get_downstream_stages
+
+
+def main(stages: List[str], img_names: List[str] = None, downstream: bool = True) -> None:
+    if downstream:
+        stages = get_downstream_stages(stages)
+    if img_names is None:
+        img_names = ImgMetadata.get_all()[get_model_column_for_mapped_name(ImgMetadata, 'img_name')].tolist()
+    invalidate_stages(stages, img_names)
+    logger.info(f'Invalidated the stages {stages} of {len(img_names)} images.')
+
+if __name__ == "__main__":
+    start_logging(__file__)
+
+    parser = argparse.ArgumentParser(description='Invalidate pipeline stages, so that they are run again for the '
+                                                 'given images.')
+    parser.add_argument('--stages',
+                        help='Specify the stages which should be run again.',
+                        nargs='+',
+                        choices=STAGES,
+                        required=True)
+    parser.add_argument('--img_names',
+                        help='Specify the images whose stages should be run again. Defaults to all images.',
+                        nargs='+',
+                        default=None)
+    parser.add_argument('--downstream',
+                        help='Specify whether all subsequent stages should be invalidated as well.',
+                        action=argparse.BooleanOptionalAction,
+                        default=True)
+    args = parser.parse_args()
+
+    main(stages=args.stages, img_names=args.img_names, downstream=args.downstream)
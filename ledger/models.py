@@ -0,0 +1,54 @@
+import config as cfg
+from typing import List
+from sqlalchemy import Column, Integer, String, Float, DateTime
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from db import engine
+from db.base import Base
+import pandas as pd
+
+class StageLedger(Base):
+    """
+    This class models the processing state of each image per pipeline stage: the status of the last run, the
+    fingerprint of its inputs and parameters, its timing and the number of rows (or windows) it has produced.
+    """
+    __tablename__ = 'stages'
+    __table_args__ = {"schema": cfg.SCHEMA_PIPELINE}
+
+    img_name = Column('img_name', String, primary_key=True)
+    stage = Column('stage', String, primary_key=True)
+    status = Column('status', String)
+    fingerprint = Column('fingerprint', String)
+    started_at = Column('started_at', DateTime)
+    finished_at = Column('finished_at', DateTime)
+    seconds = Column('seconds', Float)
+    n_rows = Column('n_rows', Integer)
+
+    @classmethod
+    def get_single_stage_entries(cls, stage: str) -> pd.DataFrame:
+        with Session(engine) as session:
+            query = session.query(cls).filter(cls.stage == stage)
+            return pd.read_sql(query.statement, engine).set_index('img_name')
+
+    @classmethod
+    def get_entry(cls, img_name: str, stage: str) -> dict:
+        with Session(engine) as session:
+            entry = session.get(cls, (img_name, stage))
+            if entry is None:
+                return None
+            return {column.key: getattr(entry, column.key) for column in cls.__mapper__.column_attrs}
+
+    @classmethod
+    def upsert(cls, entries: List[dict]) -> None:
+        """
+        Insert the entries or update the given attributes of existing entries (all entries need the same attributes).
+        """
+        if len(entries) == 0:
+            return
+        stmt = insert(cls).values(entries)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[cls.img_name, cls.stage],
+            set_={key: stmt.excluded[key] for key in entries[0] if key not in ['img_name', 'stage']})
+        with Session(engine) as session:
+            session.execute(stmt)
+            session.commit()
@@ -0,0 +1,66 @@
+import contextlib
+import hashlib
+import json
+import os
+import time
+from datetime import datetime
+from typing import Callable, Iterator, List
+from ledger.models import StageLedger
+
+STAGES = ['preprocessing', 'prediction', 'postprocessing']
+
+
+def get_fingerprint(*values) -> str:
+    """
+    Hash the inputs and parameters of a stage (any JSON serializable values).
+    """
+    return hashlib.md5(json.dumps(values, default=str).encode()).hexdigest()
+
+def get_file_fingerprint(file_path: str) -> str:
+    if not os.path.exists(file_path):
+        return None
+    return f'{os.path.getsize(file_path)}:{os.stat(file_path).st_mtime_ns}'
+
+def is_stage_current(img_name: str, stage: str, fingerprint: str, result_exists: Callable[[], bool]) -> bool:
+    """
+    A stage is current for an image if its last run has been completed with the same fingerprint and its result still
+    exists (not checked for empty results). Results of runs before the ledger existed are adopted with the current
+    fingerprint.
+    """
+    entry = StageLedger.get_entry(img_name, stage)
+    if entry is None:
+        if not result_exists():
+            return False
+        StageLedger.upsert([{'img_name': img_name, 'stage': stage, 'status': 'done', 'fingerprint': fingerprint}])
+        return True
+    return entry['status'] == 'done' and entry['fingerprint'] == fingerprint and \
+        (entry['n_rows'] == 0 or result_exists())
+
+@contextlib.contextmanager
+def record_stage(img_name: str, stage: str, fingerprint: str) -> Iterator[dict]:
+    """
+    Record a run of a stage for an image in the ledger. The number of rows produced can be set on the yielded dict. If
+    the run fails, it is recorded as failed and will be repeated by the next run.
+    """
+    started_at, start = datetime.now(), time.perf_counter()
+    StageLedger.upsert([{'img_name': img_name, 'stage': stage, 'status': 'running', 'fingerprint': fingerprint,
+                         'started_at': started_at, 'finished_at': None, 'seconds': None, 'n_rows': None}])
+    run = {'n_rows': None}
+    try:
+        yield run
+    except BaseException:
+        StageLedger.upsert([{'img_name': img_name, 'stage': stage, 'status': 'failed', 'finished_at': datetime.now(),
+                             'seconds': time.perf_counter() - start}])
+        raise
+    StageLedger.upsert([{'img_name': img_name, 'stage': stage, 'status': 'done', 'finished_at': datetime.now(),
+                         'seconds': time.perf_counter() - start, 'n_rows': run['n_rows']}])
+
+def invalidate_stages(stages: List[str], img_names: List[str]) -> None:
+    """
+    Invalidated entries are kept (instead of being deleted), so that the results of the stage are not adopted again.
+    """
+    StageLedger.upsert([{'img_name': img_name, 'stage': stage, 'status': 'invalidated'}
+                        for stage in stages for img_name in img_names])
+
+def get_downstream_stages(stages: List[str]) -> List[str]:
+    return STAGES[min(STAGES.index(stage) for stage in stages):]
@@ -4,7 +4,7 @@ echo %cd%
 set PYTHONIOENCODING=UTF-8
 set PYTHONPATH=%cd%
 call venv\Scripts\activate.bat
-python db\main.py --drop_results
+python db\main.py
 python ref_area\main.py
 python mastr\main.py
 python images\preprocessing\main.py
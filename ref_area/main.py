@@ -1,7 +1,7 @@
 import argparse
 
 from models import ZipBorders, get_base
-from db import engine, get_model_column_names
+from db import engine, get_model_column_names, copy_to_postgis
 from sqlalchemy.orm import Session
 from logs.utils import start_logging
 import geopandas as gpd
@@ -15,8 +15,10 @@ def get_raw_data() -> None:
     df.to_crs(crs=f"EPSG:{cfg.EPSG_TARGET}", inplace=True)
 
     table_name = 'zip_borders_raw'
-    df.to_postgis(con=engine,name=table_name, schema=cfg.SCHEMA_RAW_DATA, if_exists='replace', index=False, chunksize=100)
+    copy_to_postgis(df, name=table_name, schema=cfg.SCHEMA_RAW_DATA, if_exists='replace')
     with engine.connect() as con:
+        # the table is truncated instead of being dropped if it already exists (including its primary key)
+        con.execute(f'ALTER TABLE {cfg.SCHEMA_RAW_DATA}.{table_name} DROP CONSTRAINT IF EXISTS {table_name}_pkey;')
         con.execute(f'ALTER TABLE {cfg.SCHEMA_RAW_DATA}.{table_name} ADD PRIMARY KEY (plz, plz_idx);')
 
 def get_ref_area_data(base) -> None: